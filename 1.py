@@ -1,15 +1,41 @@
 import os
+import json
+import re
+import sys
+import math
+import heapq
+import asyncio
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Message
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
+    PersistenceInput,
+    TypeHandler,
     MessageHandler,
     filters,
     CallbackQueryHandler,
     ContextTypes,
 )
-from datetime import datetime
+from datetime import timedelta
+from itertools import compress, count, islice, repeat
+from operator import contains
 
 # ---------- НАСТРОЙКИ ----------
 logging.basicConfig(
@@ -22,17 +48,893 @@ MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
 ALLOWED_EXTENSIONS = ['.py', '.txt', '.json', '.mcpack', '.mcaddon', '.png', '.jpg', '.jpeg']
 SUBSCRIPTION_PRICE = 299  # руб.
 ADMIN_IDS = [6893832048]   # замените на свой TG-ID
+BOT_TOKEN = os.environ.get('BOT_TOKEN', "8244258907:AAGSOfk1CMoBku1ChaL-lTEjWdFG7ll_EYo")
 FILES_PER_PAGE = 5
+DB_PATH = os.environ.get('BOT_DB', 'bot.db')
+FLUSH_INTERVAL = 1.0  # сек. между сбросами очереди записей
+FLUSH_BATCH = 500     # сбросить раньше, если накопилось столько операций
+BUSY_TIMEOUT = 30.0   # сек. ожидания, пока БД занята другим процессом
+SQL_CHUNK = 500       # макс. параметров в одном IN (...)
+SCAN_CHUNK = 1000     # записей за одно чтение при построении индекса поиска
+SIZE_FETCH_CONCURRENCY = 5  # параллельных get_file при дозаполнении размеров
+SIZE_CACHE_TTL = 600        # сек.
+TEMP_ROOT = os.environ.get('BOT_TMP') or None  # где создать каталог временных файлов (локальный Bot API)
+TEMP_QUOTA = int(os.environ.get('BOT_TMP_QUOTA', str(2 * 1024 ** 3)))  # байт на диске под пересылки
+BUFFER_QUOTA = int(os.environ.get('BOT_BUFFER_QUOTA', str(256 * 1024 ** 2)))  # байт в памяти под пересылки
+FILE_IO_WORKERS = 4         # потоков для работы с диском
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024  # все сессии поиска вместе
+SEARCH_CACHE_TTL = 30 * 60                 # сек. бездействия до выброса сессии
+SEARCH_MAX_RESULTS = 1000   # лучших результатов в выдаче
+TOP_FILES = 10              # файлов в /top
+PRIVACY_PAGE = 10           # файлов на странице списка приватности
+PRIVACY_CACHE_USERS = 1000  # пользователей с отрисованными страницами этого списка
+
+# Режим работы: polling или webhook (нужен python-telegram-bot[webhooks])
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # публичный адрес, напр. https://bot.example.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+CONCURRENT_UPDATES = 32     # обрабатываются одновременно, не больше одного на пользователя
+MAX_PENDING_UPDATES = 1024  # принятые обновления, ждущие своей очереди
+TRANSFER_WORKERS = 4        # одновременных пересылок файлов
+USER_TRANSFERS = 2          # из них на одного пользователя
+DOWNLOAD_RATE = 0.2         # скачиваний в секунду на пользователя в среднем...
+DOWNLOAD_BURST = 5          # ...и подряд без ожидания
+RATE_LIMIT_MAX_USERS = 10000  # чистить полные корзины, когда их больше
+API_RETRIES = 3             # попыток вызова Bot API при RetryAfter
+BATCH_WINDOW = 1.5          # сек. тишины после последнего документа пакета до меню
+BATCH_MAX_FILES = 50        # документов в одном пакете
+BATCH_PREVIEW = 20          # строк списка файлов в сообщениях о пакете
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))                  # /metrics в формате Prometheus
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '0'))  # сек. между сводками в лог
+# Больше одного — обновления делятся между процессами по user_id, состояние общее через DB_PATH
+WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+SHARED_REFRESH = 1.0        # сек. между чтениями изменений других процессов
+SHARED_LOG_TTL = 3600       # сек. хранения журнала изменений и сессий поиска в БД
+PERSIST_INTERVAL = 1.0      # сек. между сохранениями user_data
 
 # ---------- СОСТОЯНИЯ ----------
 WAITING_FOR_FILE, WAITING_FOR_NAME, WAITING_FOR_EXTENSION, WAITING_FOR_SEARCH = range(4)
 
+# Списки файлов: весь каталог (/browse) или результаты поиска
+BROWSE, SEARCH = "b", "s"
+# page_<вид><номер>[<|><id>]: страница до/после файла с данным id;
+# результаты поиска — снимок в кэше, их страница задаётся номером
+PAGE_RE = re.compile(r"([bs])(\d+)(?:([<>])(\d+))?")
+
 # ---------- ХРАНИЛИЩА ----------
+# user_files — кэш файлов владельцев, подгружается из storage по мере обращения
 user_files = {}
 subscribed_users = set()
-file_search_cache = {}
+# user_id -> задача, которая покажет меню пакета после BATCH_WINDOW тишины
+batch_timers = {}
+
+# ---------- КЭШ ПОИСКА ----------
+class SearchSessionCache:
+    # user_id -> отсортированные id файлов последнего поиска (array('q'), 8 байт на файл).
+    # Сессии упорядочены по последнему обращению: выбрасываются самые старые —
+    # по таймауту бездействия или когда суммарный объём превышает max_bytes.
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._sessions = OrderedDict()  # user_id -> (ids, время обращения)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _pop(self, user_id: int) -> None:
+        ids, _ = self._sessions.pop(user_id)
+        self.bytes -= sys.getsizeof(ids)
+
+    def _evict(self, now: float) -> None:
+        while self._sessions:
+            user_id, (_, seen) = next(iter(self._sessions.items()))
+            if seen > now - self.ttl and self.bytes <= self.max_bytes:
+                break
+            self._pop(user_id)
+            self.evictions += 1
+
+    def put(self, user_id: int, ids: list) -> array:
+        if user_id in self._sessions:
+            self._pop(user_id)
+        # Один ответ не может занять больше всего бюджета — хвост отбрасывается
+        empty = array('q')
+        ids = array('q', ids[:(self.max_bytes - sys.getsizeof(empty)) // empty.itemsize])
+        now = time.monotonic()
+        self._sessions[user_id] = (ids, now)
+        self.bytes += sys.getsizeof(ids)
+        self._evict(now)
+        return ids
+
+    def get(self, user_id: int):
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._sessions[user_id] = (entry[0], now)
+        self._sessions.move_to_end(user_id)
+        return entry[0]
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+file_search_cache = SearchSessionCache(SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL)
+
+# ---------- ЗАПИСИ ФАЙЛОВ ----------
+class FileRecord:
+    # Загруженный файл. __slots__ вместо dict, расширение и MIME-тип
+    # интернированы, время — unix timestamp вместо datetime.
+    # blob — id первой записи с тем же содержимым (file_unique_id);
+    # остальные записи — её псевдонимы с другим владельцем или именем.
+    __slots__ = ('id', 'owner', 'file_id', 'filename', 'ext', 'public', 'timestamp', 'size', 'mime', 'source_name',
+                 'blob')
+
+    def __init__(self, rid: int, owner: int, file_id: str, filename: str, public: bool, timestamp: float,
+                 size, mime, source_name, blob=None):
+        self.id = rid
+        self.blob = blob or rid
+        self.owner = owner
+        self.file_id = file_id
+        self.filename = filename
+        self.ext = sys.intern(os.path.splitext(filename)[1].lower())
+        self.public = public
+        self.timestamp = timestamp
+        self.size = size
+        self.mime = sys.intern(mime) if mime else None
+        # Обычно совпадает с filename — храним ту же строку, а не копию
+        self.source_name = filename if source_name == filename else source_name
+
+# ---------- ПОСТОЯННОЕ ХРАНИЛИЩЕ ----------
+class SQLiteStorage:
+    # Каталог, подписки и общее состояние процессов. Записи копятся в памяти
+    # и сбрасываются пачками вне event loop, чтения видят все записи,
+    # поставленные в очередь до них. Одно соединение и один поток: очередь
+    # потока сохраняет порядок записей и чтений, event loop не ждёт диск.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id        INTEGER PRIMARY KEY,
+            owner     INTEGER NOT NULL,
+            file_id   TEXT    NOT NULL,
+            filename  TEXT    NOT NULL,
+            ext       TEXT    NOT NULL,
+            public    INTEGER NOT NULL DEFAULT 1,
+            timestamp REAL    NOT NULL,
+            size      INTEGER,
+            mime      TEXT,
+            source_name TEXT,
+            unique_id TEXT,
+            blob      INTEGER,
+            downloads INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS files_owner     ON files(owner);
+        CREATE INDEX IF NOT EXISTS files_filename  ON files(filename);
+        CREATE INDEX IF NOT EXISTS files_ext       ON files(ext);
+        CREATE INDEX IF NOT EXISTS files_public    ON files(public, id);
+        CREATE INDEX IF NOT EXISTS files_timestamp ON files(timestamp);
+        CREATE TABLE IF NOT EXISTS subscriptions (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq    INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin INTEGER NOT NULL,
+            kind   TEXT    NOT NULL,
+            key    INTEGER NOT NULL,
+            at     REAL    NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_at ON changes(at);
+        CREATE TABLE IF NOT EXISTS searches (user_id INTEGER PRIMARY KEY, ids BLOB NOT NULL, at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS ids (name TEXT PRIMARY KEY, next INTEGER NOT NULL);
+    """
+    # Колонки, добавленные после первой версии схемы, и индексы по ним
+    MIGRATIONS = (("size", "INTEGER"), ("mime", "TEXT"), ("source_name", "TEXT"),
+                  ("unique_id", "TEXT"), ("blob", "INTEGER"), ("downloads", "INTEGER NOT NULL DEFAULT 0"))
+    MIGRATION_SCHEMA = """
+        UPDATE files SET blob = id WHERE blob IS NULL;
+        CREATE INDEX IF NOT EXISTS files_unique ON files(unique_id);
+        CREATE INDEX IF NOT EXISTS files_blob   ON files(blob, id);
+        CREATE INDEX IF NOT EXISTS files_alias  ON files(blob) WHERE blob != id;
+    """
+    FILE_COLUMNS = "id, file_id, filename, public, timestamp, size, mime, source_name, owner, blob"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._pending = []
+        self._writing = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self.shard = None
+
+    @property
+    def shared(self) -> bool:
+        return self.shard is not None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self) -> None:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = {r[1] for r in self.conn.execute("PRAGMA table_info(files)")}
+        for name, decl in self.MIGRATIONS:
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE files ADD COLUMN {name} {decl}")
+        self.conn.executescript(self.MIGRATION_SCHEMA)
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO ids SELECT 'files', COALESCE(MAX(id), 0) + 1 FROM files")
+
+    async def open(self) -> None:
+        await self._run(self._open)
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
+        if self._pending:
+            logger.error(f"storage: при остановке не записано {len(self._pending)} операций")
+        await self._run(self.conn.close)
+        self._executor.shutdown()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @staticmethod
+    def _busy(e: sqlite3.Error) -> bool:
+        return (getattr(e, 'sqlite_errorcode', 0) & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+    def _write(self, ops: list) -> list:
+        # Пачка пишется одной транзакцией. Возвращает операции, которые надо
+        # повторить при следующем сбросе: БД занята дольше BUSY_TIMEOUT —
+        # вся пачка. При других ошибках пачка пишется по одной операции, и
+        # теряются только те, что не проходят сами
+        try:
+            with self.conn:
+                for sql, params in ops:
+                    self.conn.execute(sql, params)
+            return []
+        except sqlite3.Error as e:
+            if self._busy(e):
+                logger.warning(f"storage: БД занята, {len(ops)} операций будут повторены: {e}")
+                return ops
+            logger.warning(f"storage: пачка из {len(ops)} операций не записана, пишем по одной: {e}")
+        for i, (sql, params) in enumerate(ops):
+            try:
+                with self.conn:
+                    self.conn.execute(sql, params)
+            except sqlite3.Error as e:
+                if self._busy(e):
+                    return ops[i:]
+                logger.error(f"storage: операция отброшена: {e}: {sql} {params}")
+        return []
+
+    def _requeue(self, fut) -> None:
+        # В начало очереди: порядок записей сохраняется
+        if not fut.cancelled() and not fut.exception() and fut.result():
+            self._pending[:0] = fut.result()
+
+    def _enqueue(self, sql: str, params: tuple) -> None:
+        self._pending.append((sql, params))
+        if len(self._pending) >= FLUSH_BATCH:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        # Пачки уходят по одной: возвращённая на повтор встаёт в очередь
+        # раньше, чем уйдёт следующая
+        async with self._writing:
+            if not self._pending:
+                return
+            ops, self._pending = self._pending, []
+            fut = asyncio.get_running_loop().run_in_executor(self._executor, self._write, ops)
+            fut.add_done_callback(self._requeue)
+            try:
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # Отменённый сброс держит очередь, пока пачка не вернётся
+                await asyncio.wait([fut])
+                raise
+
+    async def _read(self, fn, *args):
+        # Очередь записей уходит в поток раньше чтения — чтение её видит
+        await self.flush()
+        return await self._run(fn, *args)
+
+    def share(self, shard: int) -> None:
+        # До open: изменения пишутся в журнал для остальных процессов
+        self.shard = shard
+
+    def _log(self, kind: str, key: int) -> None:
+        # Запись журнала уходит в той же транзакции, что и само изменение
+        if self.shared:
+            self._enqueue("INSERT INTO changes (origin, kind, key, at) VALUES (?, ?, ?, ?)",
+                          (self.shard, kind, key, time.time()))
+
+    def _allocate(self, n: int) -> int:
+        with self.conn:
+            return self.conn.execute("UPDATE ids SET next = next + ? WHERE name = 'files' RETURNING next - ?",
+                                     (n, n)).fetchone()[0]
+
+    async def new_ids(self, n: int) -> range:
+        # id выдаёт общая для всех процессов таблица, отдельной транзакцией:
+        # id растут в порядке загрузок, на нём держится пагинация каталога
+        first = await self._run(self._allocate, n)
+        return range(first, first + n)
+
+    def save_file(self, rec: FileRecord, unique_id=None) -> None:
+        self._enqueue(
+            "INSERT INTO files (id, owner, file_id, filename, ext, public, timestamp, size, mime, source_name,"
+            " unique_id, blob) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (rec.id, rec.owner, rec.file_id, rec.filename, rec.ext,
+             int(rec.public), rec.timestamp, rec.size, rec.mime, rec.source_name, unique_id, rec.blob))
+        self._log('file', rec.id)
+
+    def set_public(self, ids: list, public: bool) -> None:
+        for i in range(0, len(ids), SQL_CHUNK):
+            chunk = ids[i:i + SQL_CHUNK]
+            self._enqueue(f"UPDATE files SET public = ? WHERE id IN ({','.join('?' * len(chunk))})",
+                          (int(public), *chunk))
+        for rid in ids:
+            self._log('file', rid)
+
+    def set_size(self, rid: int, size: int) -> None:
+        self._enqueue("UPDATE files SET size = ? WHERE id = ?", (size, rid))
+
+    def set_source(self, rid: int, file_id: str, source_name: str) -> None:
+        self._enqueue("UPDATE files SET file_id = ?, source_name = ? WHERE id = ?", (file_id, source_name, rid))
+
+    def add_download(self, rid: int) -> None:
+        self._enqueue("UPDATE files SET downloads = downloads + 1 WHERE id = ?", (rid,))
+        self._log('download', rid)
+
+    def add_subscription(self, user_id: int) -> None:
+        self._enqueue("INSERT OR IGNORE INTO subscriptions (user_id) VALUES (?)", (user_id,))
+        self._log('sub', user_id)
+
+    @staticmethod
+    def _rec(row) -> FileRecord:
+        rid, file_id, filename, public, timestamp, size, mime, source_name, owner, blob = row
+        return FileRecord(rid, owner, file_id, filename, bool(public), timestamp, size, mime, source_name, blob)
+
+    async def load_subscriptions(self) -> set:
+        rows = await self._read(lambda: self.conn.execute("SELECT user_id FROM subscriptions").fetchall())
+        return {r[0] for r in rows}
+
+    async def load_owner(self, owner: int) -> list:
+        rows = await self._read(lambda: self.conn.execute(
+            f"SELECT {self.FILE_COLUMNS} FROM files WHERE owner = ? ORDER BY id", (owner,)).fetchall())
+        return [self._rec(r) for r in rows]
+
+    def _get_files(self, ids: list) -> list:
+        rows = []
+        for i in range(0, len(ids), SQL_CHUNK):
+            chunk = ids[i:i + SQL_CHUNK]
+            rows += self.conn.execute(
+                f"SELECT {self.FILE_COLUMNS} FROM files WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        return rows
+
+    async def get_files(self, ids: list) -> list:
+        by_id = {r[0]: self._rec(r) for r in await self._read(self._get_files, ids)}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def _find_blobs(self, unique_ids: list) -> list:
+        rows = []
+        for i in range(0, len(unique_ids), SQL_CHUNK):
+            chunk = unique_ids[i:i + SQL_CHUNK]
+            rows += self.conn.execute(
+                f"SELECT unique_id, {self.FILE_COLUMNS} FROM files"
+                f" WHERE unique_id IN ({','.join('?' * len(chunk))}) ORDER BY id", chunk).fetchall()
+        return rows
+
+    async def find_blobs(self, unique_ids: list) -> dict:
+        # unique_id -> первая запись с этим содержимым: её file_id и есть общий blob
+        found = {}
+        for row in await self._read(self._find_blobs, list(set(unique_ids))):
+            if row[0] not in found:
+                found[row[0]] = self._rec(row[1:])
+        return found
+
+    # Из псевдонимов одного содержимого в каталоге виден только первый доступный
+    FIRST_ALIAS = ("NOT EXISTS (SELECT 1 FROM files d WHERE d.blob = files.blob AND d.id < files.id"
+                   " AND d.public = 1 AND d.owner != ?)")
+
+    async def find_blob(self, unique_id: str):
+        return (await self.find_blobs([unique_id])).get(unique_id)
+
+    async def count_public(self, exclude_owner: int) -> int:
+        # Все подсчёты идут по индексам: публичные минус свои минус лишние
+        # псевдонимы, которые ищутся только среди содержимого с псевдонимами
+        def count_rows():
+            total = self.conn.execute("SELECT COUNT(*) FROM files WHERE public = 1").fetchone()[0]
+            own = self.conn.execute("SELECT COUNT(*) FROM files WHERE owner = ? AND +public = 1",
+                                    (exclude_owner,)).fetchone()[0]
+            extra = self.conn.execute(
+                "SELECT COUNT(*) - COUNT(DISTINCT blob) FROM files"
+                " WHERE blob IN (SELECT blob FROM files WHERE blob != id) AND +public = 1 AND owner != ?",
+                (exclude_owner,)).fetchone()[0]
+            return total - own - extra
+        return await self._read(count_rows)
+
+    async def public_page(self, exclude_owner: int, cursor, limit: int) -> list:
+        # cursor: None — первая страница, ('>', id) — после id, ('<', id) — до id
+        sql = f"SELECT {self.FILE_COLUMNS} FROM files WHERE public = 1 AND owner != ? AND {self.FIRST_ALIAS}"
+        params = [exclude_owner, exclude_owner]
+        if cursor:
+            sql += f" AND id {cursor[0]} ?"
+            params.append(cursor[1])
+        backwards = bool(cursor) and cursor[0] == '<'
+        sql += f" ORDER BY id {'DESC' if backwards else 'ASC'} LIMIT ?"
+        params.append(limit)
+        rows = await self._read(lambda: self.conn.execute(sql, params).fetchall())
+        if backwards:
+            rows.reverse()
+        return [self._rec(r) for r in rows]
+
+    async def scan_public(self, callback) -> None:
+        # callback(id, owner, filename, blob, downloads) вызывается в потоке хранилища.
+        # Чтение частями по id: между частями поток свободен для остальных запросов
+        def scan(after: int) -> int:
+            rows = self.conn.execute(
+                "SELECT id, owner, filename, blob, downloads FROM files WHERE public = 1 AND id > ?"
+                " ORDER BY id LIMIT ?", (after, SCAN_CHUNK)).fetchall()
+            for row in rows:
+                callback(*row)
+            return rows[-1][0] if len(rows) == SCAN_CHUNK else None
+        after = 0
+        while after is not None:
+            after = await self._read(scan, after)
+
+    async def last_change(self) -> int:
+        return await self._read(lambda: self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0])
+
+    async def changes_since(self, seq: int) -> list:
+        # (seq, вид, ключ) изменений других процессов; seq растёт в порядке фиксации транзакций
+        return await self._read(lambda: self.conn.execute(
+            "SELECT seq, kind, key FROM changes WHERE seq > ? AND origin != ? ORDER BY seq",
+            (seq, self.shard)).fetchall())
+
+    def save_search(self, user_id: int, ids: array) -> None:
+        self._enqueue("INSERT OR REPLACE INTO searches (user_id, ids, at) VALUES (?, ?, ?)",
+                      (user_id, ids.tobytes(), time.time()))
+
+    async def load_search(self, user_id: int, ttl: float):
+        row = await self._read(lambda: self.conn.execute(
+            "SELECT ids FROM searches WHERE user_id = ? AND at > ?", (user_id, time.time() - ttl)).fetchone())
+        if row is None:
+            return None
+        ids = array('q')
+        ids.frombytes(row[0])
+        return ids
+
+    def prune(self, before: float) -> None:
+        self._enqueue("DELETE FROM changes WHERE at < ?", (before,))
+        self._enqueue("DELETE FROM searches WHERE at < ?", (before,))
+
+storage = SQLiteStorage(DB_PATH)
+
+async def get_user_files(user_id: int) -> list:
+    if user_id not in user_files:
+        files = await storage.load_owner(user_id)
+        return user_files.setdefault(user_id, files)
+    return user_files[user_id]
+
+# ---------- ПОИСКОВЫЙ ИНДЕКС ----------
+def edit_distance(a: str, b: str) -> int:
+    # Вставки, удаления, замены и перестановки соседних символов
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[-1]
+
+class Postings:
+    # Ключ -> отсортированный array('q') id. Для запросов короче ключа —
+    # первые один-два символа -> ключи, которые с них начинаются
+    __slots__ = ('lists', 'prefixes')
+
+    def __init__(self):
+        self.lists = {}
+        self.prefixes = {}
+
+    def add(self, rid: int, keys) -> None:
+        lists = self.lists
+        for key in keys:
+            ids = lists.get(key)
+            if ids is None:
+                lists[key] = array('q', (rid,))
+                for p in {key[:1], key[:2]}:
+                    self.prefixes.setdefault(p, set()).add(key)
+            elif ids[-1] < rid:
+                # Обычный случай: id растут, загрузка из storage идёт по порядку id
+                ids.append(rid)
+            else:
+                ids.insert(bisect_left(ids, rid), rid)
+
+    def discard(self, rid: int, keys) -> None:
+        for key in keys:
+            ids = self.lists[key]
+            del ids[bisect_left(ids, rid)]
+            if not ids:
+                del self.lists[key]
+                for p in {key[:1], key[:2]}:
+                    found = self.prefixes[p]
+                    found.discard(key)
+                    if not found:
+                        del self.prefixes[p]
+
+    def starting(self, prefix: str) -> list:
+        return [self.lists[key] for key in self.prefixes.get(prefix, ())]
+
+class SearchIndex:
+    # Триграммы имени файла -> id публичных файлов, слова имени -> id (Postings).
+    # Имя дополнено START в начале и END в конце, так что с каждого символа
+    # начинается триграмма: запрос короче GRAM — слияние списков триграмм,
+    # которые с него начинаются, длиннее — самый короткий список его триграмм
+    # с проверкой подстроки. Запрос из одного слова лежит внутри слов имени:
+    # подходящие слова находит словарь (триграммы слов), дальше сливаются
+    # их списки. Совпадения идут по возрастанию id и берутся лениво: работа
+    # зависит от SEARCH_MAX_RESULTS, а не от размера каталога.
+    # Из псевдонимов одного содержимого в выдаче остаётся лучший.
+    # Опечатки: словарь слов из имён и их вариантов без одной буквы —
+    # похожие слова находятся поиском по словарю, а не перебором.
+    # Порядок выдачи — релевантность × популярность. Релевантность
+    # (слово целиком, начало слова, подстрока, опечатка) определяется по
+    # имени. Скачивавшиеся файлы ещё раз проиндексированы по уровням
+    # популярности (1, 2–3, 4–7… скачиваний): выдача обходит пары
+    # (релевантность, уровень) по убыванию оценки, внутри пары — в порядке
+    # загрузки.
+    # Индекс строится из storage в фоне при запуске (или на первом поиске,
+    # если фоновая загрузка не удалась); изменения, пришедшие во время
+    # загрузки, копятся и применяются после неё.
+    GRAM = 3
+    START = "\0"
+    END = "\1"
+    SEPARATORS = (START, "_", " ", "-", ".")
+    TOKEN_RE = re.compile(r"[^\W_]+")
+    FUZZY_MIN_LEN = 4  # короче — слишком много «похожих» слов
+    EAGER_UNION = 8192  # id в списках, которые дешевле слить сразу
+    EXACT, PREFIX, SUBSTRING, FUZZY = 3.0, 2.0, 1.0, 0.5
+
+    def __init__(self):
+        self.postings = Postings()
+        self.tokens = Postings()
+        self.names = {}
+        self.owners = {}
+        self.blobs = {}      # только псевдонимы: id -> blob
+        self.copies = {}     # blob -> публичных псевдонимов
+        self.extra = 0       # лишние публичные копии: у содержимого из n копий их n - 1
+        self.vocab = {}      # триграмма START + слова -> слова словаря
+        self.variants = {}   # слово или оно без одной буквы -> слова словаря
+        self.downloads = {}  # id -> скачиваний, только ненулевые
+        self.hot = {}        # уровень популярности -> (триграммы, слова) его публичных файлов
+        self.ready = None
+        self._backlog = None
+
+    def _grams(self, name: str) -> set:
+        name = self.START + name + self.END * (self.GRAM - 1)
+        return {name[i:i + self.GRAM] for i in range(len(name) - self.GRAM + 1)}
+
+    def _words(self, name: str) -> set:
+        return set(self.TOKEN_RE.findall(name))
+
+    @staticmethod
+    def _deletes(word: str) -> set:
+        return {word[:i] + word[i + 1:] for i in range(len(word))} | {word}
+
+    def _word_grams(self, token: str) -> set:
+        token = self.START + token
+        return {token[i:i + self.GRAM] for i in range(len(token) - self.GRAM + 1)}
+
+    def _add_tokens(self, rid: int, words: set) -> None:
+        for token in words:
+            if token in self.tokens.lists:
+                continue
+            for g in self._word_grams(token):
+                self.vocab.setdefault(g, set()).add(token)
+            if len(token) >= self.FUZZY_MIN_LEN:
+                for v in self._deletes(token):
+                    self.variants.setdefault(v, set()).add(token)
+        self.tokens.add(rid, words)
+
+    def _drop_tokens(self, rid: int, words: set) -> None:
+        self.tokens.discard(rid, words)
+        for token in words:
+            if token in self.tokens.lists:
+                continue
+            self._unlink(self.vocab, self._word_grams(token), token)
+            if len(token) >= self.FUZZY_MIN_LEN:
+                self._unlink(self.variants, self._deletes(token), token)
+
+    @staticmethod
+    def _unlink(table: dict, keys: set, token: str) -> None:
+        for key in keys:
+            found = table[key]
+            found.discard(token)
+            if not found:
+                del table[key]
+
+    def _heat(self, rid: int, n: int, grams: set, words: set) -> None:
+        level = self.hot.get(n.bit_length())
+        if level is None:
+            level = self.hot[n.bit_length()] = (Postings(), Postings())
+        level[0].add(rid, grams)
+        level[1].add(rid, words)
+
+    def _cool(self, rid: int, n: int, grams: set, words: set) -> None:
+        level = self.hot[n.bit_length()]
+        level[0].discard(rid, grams)
+        level[1].discard(rid, words)
+        if not level[0].lists:
+            del self.hot[n.bit_length()]
+
+    def _add(self, rid: int, owner: int, filename: str, blob: int, downloads: int = 0) -> None:
+        if rid in self.names:
+            return
+        name = filename.lower()
+        self.names[rid] = name
+        self.owners[rid] = owner
+        if blob != rid:
+            self.blobs[rid] = blob
+            self.copies[blob] = self.copies.get(blob, 0) + 1
+        self.extra += self._copies(blob) > 1
+        if downloads:
+            self.downloads[rid] = downloads
+        grams, words = self._grams(name), self._words(name)
+        self.postings.add(rid, grams)
+        self._add_tokens(rid, words)
+        n = self.downloads.get(rid)
+        if n:
+            self._heat(rid, n, grams, words)
+
+    def _discard(self, rid: int) -> None:
+        # Счётчик скачиваний остаётся: файл может снова стать публичным
+        if rid not in self.names:
+            return
+        blob = self.blobs.pop(rid, rid)
+        self.extra -= self._copies(blob) > 1
+        if blob != rid:
+            self.copies[blob] -= 1
+            if not self.copies[blob]:
+                del self.copies[blob]
+        name = self.names.pop(rid)
+        del self.owners[rid]
+        grams, words = self._grams(name), self._words(name)
+        self.postings.discard(rid, grams)
+        self._drop_tokens(rid, words)
+        n = self.downloads.get(rid)
+        if n:
+            self._cool(rid, n, grams, words)
+
+    def _copies(self, blob: int) -> int:
+        return self.copies.get(blob, 0) + (blob in self.names)
+
+    def visible(self, own: list) -> int:
+        # Сколько файлов видит в каталоге владелец own: публичные без своих
+        # и без лишних псевдонимов (как FIRST_ALIAS в storage). Своё
+        # содержимое из n копий, k из которых свои, даёт min(k, n - 1)
+        # лишних меньше
+        mine = {}
+        for f in own:
+            if f.id in self.names:
+                mine[f.blob] = mine.get(f.blob, 0) + 1
+        extra = self.extra - sum(min(k, self._copies(blob) - 1) for blob, k in mine.items())
+        return len(self.names) - sum(mine.values()) - extra
+
+    @property
+    def loaded(self) -> bool:
+        return (self.ready is not None and self.ready.done()
+                and not self.ready.cancelled() and not self.ready.exception())
+
+    def _record_download(self, rid: int) -> None:
+        n = self.downloads.get(rid, 0) + 1
+        self.downloads[rid] = n
+        name = self.names.get(rid)
+        if name is not None and n.bit_length() != (n - 1).bit_length():
+            # Файл перешёл на следующий уровень популярности
+            grams, words = self._grams(name), self._words(name)
+            if n > 1:
+                self._cool(rid, n - 1, grams, words)
+            self._heat(rid, n, grams, words)
+
+    def _apply(self, op, *args) -> None:
+        # До загрузки изменения не нужны: индекс прочитает их из storage
+        if self._backlog is not None:
+            self._backlog.append((op, args))
+        elif self.ready is not None and self.ready.done():
+            op(*args)
+
+    def add(self, rid: int, owner: int, filename: str, blob: int) -> None:
+        self._apply(self._add, rid, owner, filename, blob)
+
+    def discard(self, rid: int) -> None:
+        self._apply(self._discard, rid)
+
+    def record_download(self, rid: int) -> None:
+        self._apply(self._record_download, rid)
+
+    async def _load(self) -> None:
+        self._backlog = []
+        fresh = SearchIndex()
+        try:
+            await storage.scan_public(fresh._add)
+            for attr in ('postings', 'tokens', 'names', 'owners', 'blobs', 'copies', 'extra', 'vocab', 'variants',
+                         'downloads', 'hot'):
+                setattr(self, attr, getattr(fresh, attr))
+            for op, args in self._backlog:
+                op(*args)
+        finally:
+            self._backlog = None
+
+    def start(self) -> None:
+        # Построение в фоне сразу после запуска, а не на первом поиске
+        if self.ready is None:
+            self.ready = asyncio.ensure_future(self._load())
+            self.ready.add_done_callback(self._loaded)
+
+    @staticmethod
+    def _loaded(fut) -> None:
+        if not fut.cancelled() and fut.exception():
+            logger.error(f"search index: не построен: {fut.exception()}")
+
+    def stop(self) -> None:
+        if self.ready is not None and not self.ready.done():
+            self.ready.cancel()
+
+    async def ensure_loaded(self) -> None:
+        # После ошибки фоновой загрузки пробуем снова
+        if self.ready is None or (self.ready.done() and (self.ready.cancelled() or self.ready.exception())):
+            self.ready = asyncio.ensure_future(self._load())
+        await asyncio.shield(self.ready)
+
+    @staticmethod
+    def _merge(streams):
+        # Слияние возрастающих потоков id без повторов
+        last = None
+        for i in heapq.merge(*streams):
+            if i != last:
+                last = i
+                yield i
+
+    def _union(self, lists: list):
+        # Небольшие списки сливаются сразу в C, длинные — лениво, по мере выдачи
+        if len(lists) == 1:
+            return lists[0]
+        if sum(map(len, lists)) <= self.EAGER_UNION:
+            return sorted(set().union(*lists))
+        return self._merge(lists)
+
+    def _match(self, query: str, grams: Postings, words: Postings):
+        # id имён с подстрокой query по возрастанию
+        if len(query) < self.GRAM:
+            lists = grams.starting(query)
+        elif self.TOKEN_RE.fullmatch(query):
+            # Подстрока из одного слова лежит внутри слова имени: подходящие
+            # слова находит словарь, дальше сливаются их готовые списки
+            lists = self._word_lists(query, words)
+        else:
+            lists = [grams.lists.get(query[i:i + self.GRAM]) for i in range(len(query) - self.GRAM + 1)]
+            if not all(lists):
+                return ()
+            shortest = min(lists, key=len)
+            if len(query) == self.GRAM:
+                return shortest
+            # Проверка подстроки целиком в C: compress/map без цикла в Python
+            test = contains
+            if query[0] == self.START:
+                test, query = str.startswith, query[1:]
+            return compress(shortest, map(test, map(self.names.__getitem__, shortest), repeat(query)))
+        return self._union(lists)
+
+    def _word_lists(self, part: str, words: Postings) -> list:
+        # Списки id слов словаря с подстрокой part; START в начале — слова,
+        # которые с part начинаются
+        sets = sorted((self.vocab.get(part[i:i + self.GRAM], ()) for i in range(len(part) - self.GRAM + 1)), key=len)
+        found = set(sets[0]).intersection(*sets[1:])
+        if part[0] == self.START:
+            found = {t for t in found if t.startswith(part[1:])}
+        else:
+            found = {t for t in found if part in t}
+        return [words.lists[t] for t in found if t in words.lists]
+
+    def similar(self, word: str) -> set:
+        # Слова словаря на расстоянии одной правки от word
+        found = set()
+        for v in self._deletes(word):
+            found |= self.variants.get(v, set())
+        found.discard(word)
+        return {t for t in found if edit_distance(t, word) == 1}
+
+    def search(self, query: str, exclude_owner: int) -> list:
+        names, owners, blobs, downloads = self.names, self.owners, self.blobs, self.downloads
+        word = self.TOKEN_RE.match(query)
+        single = self.TOKEN_RE.fullmatch(query)
+        whole = re.compile(rf"(?<![^\W_]){re.escape(query)}(?![^\W_])").search
+        starts = re.compile(rf"(?:^|[{re.escape(''.join(self.SEPARATORS[1:]))}]){re.escape(query)}").search
+        similar = ()
+        # Опечатки ищутся, пока точных совпадений не хватает на всю выдачу
+        if (len(query) >= self.FUZZY_MIN_LEN and single and len(list(
+                islice(self._match(query, self.postings, self.tokens), SEARCH_MAX_RESULTS))) < SEARCH_MAX_RESULTS):
+            similar = self.similar(query)
+
+        def weight(name: str):
+            if query in name:
+                if word and starts(name):
+                    return self.EXACT if whole(name) else self.PREFIX
+                return self.SUBSTRING
+            if any(w in name for w in similar):
+                return self.FUZZY
+            return None
+
+        def stream(w: float, grams: Postings, words: Postings):
+            # Возрастающие id — надмножество имён с релевантностью w
+            if w == self.FUZZY:
+                return self._merge([self._match(s, grams, words) for s in similar])
+            if w == self.SUBSTRING:
+                return self._match(query, grams, words)
+            if single and w == self.EXACT:
+                return words.lists.get(query, ())
+            if single and len(query) >= self.GRAM - 1:
+                # Начало слова — слова словаря с этим началом
+                return self._union(self._word_lists(self.START + query, words))
+            return self._merge([self._match(sep + query, grams, words) for sep in self.SEPARATORS])
+
+        weights = (self.EXACT, self.PREFIX, self.SUBSTRING) if word else (self.SUBSTRING,)
+        if similar:
+            weights += (self.FUZZY,)
+        # (оценка, вес, уровень, индекс): нескачивавшиеся — уровень 0, общий индекс
+        passes = [(w, w, 0, self.postings, self.tokens) for w in weights]
+        for level, (grams, words) in self.hot.items():
+            boost = 1.0 + math.log1p(1 << (level - 1))
+            passes += [(w * boost, w, level, grams, words) for w in weights]
+        passes.sort(key=lambda p: -p[0])
+
+        found, seen = [], set()
+        for _, w, level, grams, words in passes:
+            for i in stream(w, grams, words):
+                # Скачивавшиеся в общем индексе пропускаются: их выдаёт индекс уровня
+                if (level or i not in downloads) and owners[i] != exclude_owner and weight(names[i]) == w:
+                    blob = blobs.get(i, i)
+                    if blob not in seen:
+                        seen.add(blob)
+                        found.append(i)
+                        if len(found) == SEARCH_MAX_RESULTS:
+                            return found
+        return found
+
+    def popular(self, exclude_owner: int, limit: int) -> list:
+        # (id, скачиваний) самых скачиваемых публичных файлов
+        ids = (i for i in self.downloads if i in self.names and self.owners[i] != exclude_owner)
+        return [(i, self.downloads[i]) for i in heapq.nlargest(limit, ids, key=self.downloads.get)]
+
+search_index = SearchIndex()
 
 # ---------- УТИЛИТЫ ----------
+# file_id -> (размер, истекает); держит и неудачные запросы, чтобы не повторять их на каждой странице
+size_cache = {}
+
 async def get_file_size(bot, file_id: str) -> int:
     try:
         file = await bot.get_file(file_id)
@@ -40,30 +942,359 @@ async def get_file_size(bot, file_id: str) -> int:
     except Exception:
         return 0
 
+async def fill_sizes(bot, files: list) -> None:
+    # Размер пишется при загрузке; get_file нужен только старым записям без него
+    now = time.monotonic()
+    missing = []
+    for f in files:
+        if f.size is not None:
+            continue
+        cached = size_cache.get(f.file_id)
+        if cached and cached[1] > now:
+            f.size = cached[0]
+        else:
+            missing.append(f)
+    if not missing:
+        return
+
+    sem = asyncio.Semaphore(SIZE_FETCH_CONCURRENCY)
+
+    async def fetch(f: FileRecord) -> int:
+        async with sem:
+            return await get_file_size(bot, f.file_id)
+
+    sizes = await asyncio.gather(*(fetch(f) for f in missing))
+    for fid in [k for k, (_, exp) in size_cache.items() if exp <= now]:
+        del size_cache[fid]
+    for f, size in zip(missing, sizes):
+        size_cache[f.file_id] = (size, now + SIZE_CACHE_TTL)
+        f.size = size
+        if size:
+            storage.set_size(f.id, size)
+
+# ---------- ПЕРЕСЫЛКИ ----------
+class TransferPool:
+    # Пересылки файлов идут фоновыми задачами, не больше workers одновременно.
+    # Обработчик кнопки сразу освобождается, и долгие загрузки не занимают
+    # слоты обработки обновлений, нужные лёгким кнопкам. После RetryAfter
+    # новые пересылки не стартуют, пока Telegram не разрешит.
+    def __init__(self, workers: int):
+        self._slots = asyncio.Semaphore(workers)
+        self._free = workers  # слотов, не занятых начатыми пересылками
+        self._tasks = set()
+        self._waiting = 0
+        self._per_user = {}
+        self._resume_at = 0.0
+
+    def active_for(self, user_id: int) -> int:
+        return self._per_user.get(user_id, 0)
+
+    def submit(self, coro, user_id: int) -> int:
+        # Возвращает место в очереди; 0 — пересылка начинается сразу.
+        # Ждущие ещё не заняли свободные слоты, но займут их раньше этой
+        position = max(0, self._waiting + 1 - self._free)
+        self._waiting += 1
+        self._per_user[user_id] = self.active_for(user_id) + 1
+        task = asyncio.create_task(self._run(coro, user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return position
+
+    async def _run(self, coro, user_id: int):
+        started = False
+        try:
+            async with self._slots:
+                self._waiting -= 1
+                self._free -= 1
+                started = True
+                delay = self._resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                return await coro
+        finally:
+            if started:
+                self._free += 1
+            else:
+                self._waiting -= 1
+                coro.close()
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+    def active(self) -> int:
+        return len(self._tasks)
+
+    def backoff(self, seconds: float) -> None:
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+transfers = TransferPool(TRANSFER_WORKERS)
+
+class RateLimiter:
+    # Token bucket на пользователя: burst действий сразу, дальше rate в секунду
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # user_id -> (токены, время последнего обращения)
+
+    def retry_in(self, user_id: int) -> float:
+        # 0 — действие разрешено и токен списан, иначе — сколько секунд ждать
+        now = time.monotonic()
+        tokens, seen = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - seen) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > RATE_LIMIT_MAX_USERS:
+            # Полные корзины ничем не отличаются от отсутствующих
+            full = now - self.burst / self.rate
+            self._buckets = {uid: b for uid, b in self._buckets.items() if b[1] > full}
+        return 0.0
+
+download_limiter = RateLimiter(DOWNLOAD_RATE, DOWNLOAD_BURST)
+
+async def call_with_retry(make_call):
+    # Повторяет вызов Bot API после RetryAfter, придерживая остальные пересылки
+    for attempt in range(1, API_RETRIES + 1):
+        try:
+            return await make_call()
+        except RetryAfter as e:
+            if attempt == API_RETRIES:
+                raise
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"RetryAfter {delay} сек., попытка {attempt}")
+            transfers.backoff(delay)
+            await asyncio.sleep(delay)
+
+file_io = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix="fileio")
+
+async def run_io(fn, *args):
+    # Всё, что трогает диск, выполняется здесь, а не в event loop
+    return await asyncio.get_running_loop().run_in_executor(file_io, fn, *args)
+
+class ByteQuota:
+    # Квота на байты пересылок: пересылка ждёт, пока место освободится
+    def __init__(self, quota: int):
+        self.quota = quota
+        self.used = 0
+        self._freed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        async with self._freed:
+            # Пересылка крупнее квоты тоже пройдёт, но только в одиночку
+            await self._freed.wait_for(lambda: not self.used or self.used + size <= self.quota)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self._freed:
+                self.used -= size
+                self._freed.notify_all()
+
+class TempFiles(ByteQuota):
+    # Временные файлы пересылок через локальный Bot API сервер: свой каталог на время работы бота,
+    # квота на занятое место, удаление файла при любом исходе пересылки.
+    def __init__(self, root, quota: int):
+        super().__init__(quota)
+        self.root = root
+        self.path = None
+        self._ids = count(1)
+
+    async def open(self) -> None:
+        self.path = await run_io(lambda: tempfile.mkdtemp(prefix="bot-", dir=self.root))
+
+    async def close(self) -> None:
+        if self.path:
+            await run_io(shutil.rmtree, self.path, True)
+
+    @asynccontextmanager
+    async def file(self, size: int, filename: str):
+        # Путь вида <каталог>/<n>/<filename>: имя файла на диске — то, под которым его отправим
+        async with self.reserve(size):
+            folder = os.path.join(self.path, str(next(self._ids)))
+            try:
+                await run_io(os.mkdir, folder)
+                yield os.path.join(folder, os.path.basename(filename) or "file")
+            finally:
+                await run_io(shutil.rmtree, folder, True)
+
+temp_files = TempFiles(TEMP_ROOT, TEMP_QUOTA)
+# Облачный Bot API отдаёт файл только целиком в память (File.download_* тоже)
+buffers = ByteQuota(BUFFER_QUOTA)
+
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+async def send_stored_file(bot, chat_id: int, file_id: str, source_name: str, filename: str,
+                           **kwargs) -> Message:
+    # Документ с тем же именем Telegram пересылает по file_id, без скачивания
+    if filename == source_name:
+        return await call_with_retry(lambda: bot.send_document(chat_id=chat_id, document=file_id, **kwargs))
+
+    # Новое имя требует повторной загрузки
+    tg_file = await call_with_retry(lambda: bot.get_file(file_id))
+    if not bot.local_mode:
+        # Скачанные байты сразу уходят в отправку: без диска и без копии
+        # в bytearray, как у download_as_bytearray. Место в памяти берётся
+        # до скачивания
+        async with buffers.reserve(tg_file.file_size or MAX_FILE_SIZE):
+            data = await bot.request.retrieve(tg_file.file_path)
+            return await call_with_retry(lambda: bot.send_document(
+                chat_id=chat_id, document=InputFile(data, filename=filename), **kwargs))
+
+    async with temp_files.file(tg_file.file_size or MAX_FILE_SIZE, filename) as path:
+        # Локальный Bot API сервер: файл уже на диске, отдаём ему ссылку
+        # на него под новым именем — бот байты не читает вовсе
+        await run_io(link_or_copy, tg_file.file_path, path)
+        return await call_with_retry(lambda: bot.send_document(chat_id=chat_id, document=path, **kwargs))
+
+# ---------- МЕНЮ ----------
+# Тексты и клавиатуры, которые не зависят от пользователя, собираются один
+# раз при запуске; объекты telegram неизменяемы и отправляются повторно
+def keyboard(*rows) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data)] for text, data in rows])
+
+WELCOME_TEXT = (
+    "📁 Просто отправь мне файл и выбери действие.\n"
+    "🔹 Можно изменить имя/расширение\n"
+    "🔹 Подписка за 299₽ — доступ ко всем файлам\n\n"
+    "📏 Макс. размер: 100 МБ\n📌 Разрешены:\n"
+) + "\n".join(f"• {e}" for e in ALLOWED_EXTENSIONS)
+START_MARKUP = keyboard(
+    ("💳 Подписка", "cmd_subscribe"),
+    ("🔐 Приватность", "cmd_privacy"),
+    ("📂 Просмотр файлов", "cmd_browse"),
+    ("🔍 Поиск", "cmd_search"),
+)
+PRIVACY_TEXT = "🔐 Настройки приватности файлов:\n\n• Публичные — видны подписчикам\n• Приватные — только вам"
+PRIVACY_MARKUP = keyboard(
+    ("🔓 Сделать все публичными", "set_all_public"),
+    ("🔒 Сделать все приватными", "set_all_private"),
+    ("📋 Управлять отдельными файлами", "manage_individual"),
+)
+FILE_MARKUP = keyboard(
+    ("✏️ Изменить имя", "change_name"),
+    ("🔄 Изменить расширение", "change_ext"),
+    ("✅ Сохранить как есть", "keep_as_is"),
+)
+RENAMED_MARKUP = keyboard(
+    ("✅ Сохранить", "confirm_save"),
+    ("✏️ Изменить имя", "change_name"),
+    ("🔄 Изменить расширение", "change_ext"),
+)
+NEW_EXT_MARKUP = keyboard(
+    ("✏️ Изменить имя", "change_name"),
+    ("🔄 Изменить расширение", "change_ext"),
+    ("✅ Сохранить", "confirm_save"),
+)
+EXT_MARKUP = keyboard(*((ext, f"set_ext{ext}") for ext in ALLOWED_EXTENSIONS), ("◀️ Назад", "back_to_main"))
+BATCH_MARKUP = keyboard(
+    ("✏️ Общее имя", "change_name"),
+    ("🔄 Общее расширение", "change_ext"),
+    ("✅ Сохранить все", "keep_as_is"),
+    ("❌ Отменить", "batch_cancel"),
+)
+
+class PrivacyPages:
+    # Страницы списка «Управлять отдельными файлами»: по PRIVACY_PAGE файлов,
+    # чтобы не упираться в лимиты Telegram на длину сообщения и число кнопок.
+    # Отрисованная страница хранится, пока не изменится файл на ней;
+    # хранятся страницы max_users последних пользователей.
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._pages = OrderedDict()  # user_id -> {номер страницы: (текст, клавиатура)}
+
+    def get(self, user_id: int, files: list, page: int) -> tuple:
+        pages = self._pages.get(user_id)
+        if pages is None:
+            pages = self._pages[user_id] = {}
+            if len(self._pages) > self.max_users:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(user_id)
+        page = max(0, min(page, (len(files) - 1) // PRIVACY_PAGE))
+        if page not in pages:
+            pages[page] = self._render(files, page)
+        return pages[page]
+
+    @staticmethod
+    def _render(files: list, page: int) -> tuple:
+        start = page * PRIVACY_PAGE
+        chunk = files[start:start + PRIVACY_PAGE]
+        lines = [f"{i}. {'🔓' if f.public else '🔒'} {f.filename}" for i, f in enumerate(chunk, start + 1)]
+        kb = [[InlineKeyboardButton(f"{'Скрыть' if f.public else 'Показать'} {f.filename}",
+                                    callback_data=f"toggle_{i}")] for i, f in enumerate(chunk, start)]
+        nav = []
+        if page:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"privacy_{page - 1}"))
+        if start + PRIVACY_PAGE < len(files):
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"privacy_{page + 1}"))
+        if nav:
+            kb.append(nav)
+        kb.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_privacy")])
+        text = f"📋 Ваши файлы (стр. {page + 1}):\n\n" + "\n".join(lines)
+        return text, InlineKeyboardMarkup(kb)
+
+    def changed(self, user_id: int, index: int) -> None:
+        pages = self._pages.get(user_id)
+        if pages:
+            pages.pop(index // PRIVACY_PAGE, None)
+
+    def appended(self, user_id: int, index: int) -> None:
+        self.changed(user_id, index)
+        if index and index % PRIVACY_PAGE == 0:
+            # Новая страница — у предыдущей появляется кнопка «вперёд»
+            self.changed(user_id, index - 1)
+
+    def reset(self, user_id: int) -> None:
+        self._pages.pop(user_id, None)
+
+privacy_pages = PrivacyPages(PRIVACY_CACHE_USERS)
+
 # ---------- ОБЩИЕ ФУНКЦИИ ----------
 def user_id_from_update(update: Update) -> int:
     if update.callback_query:
         return update.callback_query.from_user.id
     return update.effective_user.id
 
+async def reply(update: Update, text: str, **kwargs) -> None:
+    # Ответ новым сообщением и на команду, и на нажатие кнопки
+    message = update.callback_query.message if update.callback_query else update.message
+    await message.reply_text(text, **kwargs)
+
+def is_subscriber(user_id: int) -> bool:
+    return user_id in subscribed_users
+
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
+
+def allowed(check, denied: str, alert: bool = False):
+    # Проверка доступа перед обработчиком команды или кнопки;
+    # alert — отказ всплывающим окном, для кнопок, которые отвечают сами
+    def middleware(handler):
+        async def wrapper(update, context, *args):
+            if not check(user_id_from_update(update)):
+                if alert:
+                    await update.callback_query.answer(denied, show_alert=True)
+                else:
+                    await reply(update, denied)
+                return
+            return await handler(update, context, *args)
+        return wrapper
+    return middleware
+
 # ---------- КОМАНДЫ ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    welcome = (
-        f"👋 Привет, {user.first_name}!\n\n"
-        "📁 Просто отправь мне файл и выбери действие.\n"
-        "🔹 Можно изменить имя/расширение\n"
-        "🔹 Подписка за 299₽ — доступ ко всем файлам\n\n"
-        "📏 Макс. размер: 100 МБ\n📌 Разрешены:\n"
-    ) + "\n".join(f"• {e}" for e in ALLOWED_EXTENSIONS)
-
-    kb = [
-        [InlineKeyboardButton("💳 Подписка", callback_data="cmd_subscribe")],
-        [InlineKeyboardButton("🔐 Приватность", callback_data="cmd_privacy")],
-        [InlineKeyboardButton("📂 Просмотр файлов", callback_data="cmd_browse")],
-        [InlineKeyboardButton("🔍 Поиск", callback_data="cmd_search")],
-    ]
-    await update.message.reply_text(welcome, reply_markup=InlineKeyboardMarkup(kb), parse_mode='HTML')
+    welcome = f"👋 Привет, {user.first_name}!\n\n{WELCOME_TEXT}"
+    await update.message.reply_text(welcome, reply_markup=START_MARKUP, parse_mode='HTML')
     context.user_data['state'] = WAITING_FOR_FILE
 
 async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -74,8 +1305,9 @@ async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "Используйте:\n"
         "/browse - просмотр файлов\n"
         "/search - поиск файлов\n"
+        "/top - популярные файлы\n"
         "/privacy - настройки приватности"
-    ) if user_id in subscribed_users else (
+    ) if is_subscriber(user_id) else (
         "🔒 Премиум-подписка\n\n"
         "💰 Стоимость: 299 руб./месяц\n\n"
         "Возможности:\n"
@@ -85,99 +1317,81 @@ async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "• Статистика популярных файлов\n\n"
         "Для покупки свяжитесь с @admin"
     )
-    if update.callback_query:
-        await update.callback_query.message.reply_text(txt)
-    else:
-        await update.message.reply_text(txt)
+    await reply(update, txt)
 
 async def toggle_privacy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = user_id_from_update(update)
-    files = user_files.get(user_id, [])
+    files = await get_user_files(user_id)
     if not files:
         txt = "У вас еще нет загруженных файлов."
-        if update.callback_query:
-            await update.callback_query.message.reply_text(txt)
-        else:
-            await update.message.reply_text(txt)
+        await reply(update, txt)
         return
 
-    kb = [
-        [InlineKeyboardButton("🔓 Сделать все публичными", callback_data="set_all_public")],
-        [InlineKeyboardButton("🔒 Сделать все приватными", callback_data="set_all_private")],
-        [InlineKeyboardButton("📋 Управлять отдельными файлами", callback_data="manage_individual")],
-    ]
-    txt = "🔐 Настройки приватности файлов:\n\n• Публичные — видны подписчикам\n• Приватные — только вам"
-    if update.callback_query:
-        await update.callback_query.message.reply_text(txt, reply_markup=InlineKeyboardMarkup(kb))
-    else:
-        await update.message.reply_text(txt, reply_markup=InlineKeyboardMarkup(kb))
+    await reply(update, PRIVACY_TEXT, reply_markup=PRIVACY_MARKUP)
 
+@allowed(is_subscriber, "🔒 Поиск файлов доступен только подписчикам.")
 async def search_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = user_id_from_update(update)
-    if user_id not in subscribed_users:
-        txt = "🔒 Поиск файлов доступен только подписчикам."
-        if update.callback_query:
-            await update.callback_query.message.reply_text(txt)
-        else:
-            await update.message.reply_text(txt)
-        return
-    txt = "🔍 Введите поисковый запрос (имя или расширение):"
-    if update.callback_query:
-        await update.callback_query.message.reply_text(txt)
-    else:
-        await update.message.reply_text(txt)
+    await reply(update, "🔍 Введите поисковый запрос (имя или расширение):")
     context.user_data['state'] = WAITING_FOR_SEARCH
 
+@allowed(is_subscriber, "🔒 Доступно только подписчикам.")
 async def browse_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = user_id_from_update(update)
-    if user_id not in subscribed_users:
-        txt = "🔒 Доступно только подписчикам."
-        if update.callback_query:
-            await update.callback_query.message.reply_text(txt)
-        else:
-            await update.message.reply_text(txt)
-        return
+    await show_files_page(update, context, user_id_from_update(update), BROWSE)
 
-    public_files = [f for uid, files in user_files.items()
-                    if uid != user_id for f in files if f.get('public', True)]
-    if not public_files:
-        txt = "📭 Пока нет публичных файлов."
-        if update.callback_query:
-            await update.callback_query.message.reply_text(txt)
-        else:
-            await update.message.reply_text(txt)
-        return
+async def fetch_page(user_id: int, kind: str, page: int, cursor) -> tuple:
+    # Возвращает (файлы страницы, всего файлов) или None, если результаты поиска устарели
+    if kind == BROWSE:
+        files = await storage.public_page(user_id, cursor, FILES_PER_PAGE)
+        if not files:
+            return files, 0
+        if search_index.loaded:
+            # Подсчёт в storage обходит весь каталог — индекс считает по памяти
+            return files, search_index.visible(await get_user_files(user_id))
+        return files, await storage.count_public(user_id)
 
-    file_search_cache[user_id] = [public_files, 0]
-    await show_files_page(update, context, user_id, 0)
+    ids = file_search_cache.get(user_id)
+    if ids is None and storage.shared:
+        # Поиск мог быть сделан до перезапуска процесса
+        ids = await storage.load_search(user_id, SEARCH_CACHE_TTL)
+        if ids is not None:
+            file_search_cache.put(user_id, ids)
+    if ids is None:
+        return None
+    start = page * FILES_PER_PAGE
+    return await storage.get_files(ids[start:start + FILES_PER_PAGE]), len(ids)
 
-async def show_files_page(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, page: int) -> None:
-    if user_id not in file_search_cache:
-        if update.callback_query:
-            await update.callback_query.message.reply_text("❌ Результаты устарели.")
-        else:
-            await update.message.reply_text("❌ Результаты устарели.")
+async def show_files_page(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, kind: str,
+                          page: int = 0, cursor=None) -> None:
+    result = await fetch_page(user_id, kind, page, cursor)
+    if result and not result[0] and cursor:
+        # Список изменился и страница опустела — начинаем сначала
+        page, cursor = 0, None
+        result = await fetch_page(user_id, kind, page, cursor)
+    if not result:
+        await reply(update, "❌ Результаты устарели.")
         return
 
-    files, _ = file_search_cache[user_id]
-    total = (len(files) + FILES_PER_PAGE - 1) // FILES_PER_PAGE
+    files, count = result
+    if kind == BROWSE and not files:
+        await reply(update, "📭 Пока нет публичных файлов.")
+        return
+    total = max(1, (count + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
     page = max(0, min(page, total - 1))
-    start, end = page * FILES_PER_PAGE, min((page + 1) * FILES_PER_PAGE, len(files))
 
-    msg = f"📂 Найдено файлов: {len(files)}  |  Страница {page + 1}/{total}\n\n"
+    msg = f"📂 Найдено файлов: {count}  |  Страница {page + 1}/{total}\n\n"
     kb = []
-    for i in range(start, end):
-        f = files[i]
-        size = await get_file_size(context.bot, f['file_id'])
+    await fill_sizes(context.bot, files)
+    for f in files:
+        size = f.size
         size_str = f"{size / 1024 / 1024:.1f}MB" if size > 1024 * 1024 else f"{size / 1024:.1f}KB"
-        msg += f"📄 {f['filename']} ({size_str})\n"
-        kb.append([InlineKeyboardButton(f"⬇️ {f['filename']}", callback_data=f"download_{i}")])
+        msg += f"📄 {f.filename} ({size_str})\n"
+        kb.append([InlineKeyboardButton(f"⬇️ {f.filename}", callback_data=f"download_{f.id}")])
 
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page_{page - 1}"))
-    if page < total - 1:
-        nav.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"page_{page + 1}"))
+    if page > 0 and files:
+        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page_{kind}{page - 1}<{files[0].id}"))
+    if page < total - 1 and files:
+        nav.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"page_{kind}{page + 1}>{files[-1].id}"))
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton("🔍 Новый поиск", callback_data="new_search")])
@@ -188,32 +1402,56 @@ async def show_files_page(update: Update, context: ContextTypes.DEFAULT_TYPE, us
     else:
         await update.message.reply_text(msg, reply_markup=reply_markup)
 
-async def download_file(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int) -> None:
+async def download_file(update: Update, context: ContextTypes.DEFAULT_TYPE, rid: int) -> None:
     user_id = update.callback_query.from_user.id
-    if user_id not in file_search_cache:
-        await update.callback_query.answer("❌ Файл недоступен", show_alert=True)
-        return
-    files, _ = file_search_cache[user_id]
-    if not (0 <= idx < len(files)):
+    files = await storage.get_files([rid])
+    if not files or not (files[0].public or files[0].owner == user_id):
         await update.callback_query.answer("❌ Файл не найден", show_alert=True)
         return
+    if transfers.active_for(user_id) >= USER_TRANSFERS:
+        await update.callback_query.answer("⏳ Дождитесь окончания текущих загрузок", show_alert=True)
+        return
+    wait = download_limiter.retry_in(user_id)
+    if wait:
+        await update.callback_query.answer(f"⏳ Слишком часто. Попробуйте через {int(wait) + 1} сек.", show_alert=True)
+        return
 
-    f = files[idx]
+    position = transfers.submit(send_download(context.bot, update.callback_query, files[0]), user_id)
+    storage.add_download(rid)
+    search_index.record_download(rid)
+    await update.callback_query.answer(f"⏳ Место в очереди: {position}" if position else "⏳ Загружаем...")
+
+async def send_download(bot, query, f: FileRecord) -> None:
     try:
-        await update.callback_query.answer("⏳ Загружаем...")
-        tg_file = await context.bot.get_file(f['file_id'])
-        path = await tg_file.download_to_drive()
-        with open(path, 'rb') as fp:
-            await context.bot.send_document(
-                chat_id=update.callback_query.message.chat_id,
-                document=fp,
-                filename=f['filename'],
-                caption=f"✅ {f['filename']}"
-            )
-        os.remove(path)
+        sent = await send_stored_file(
+            bot, query.message.chat_id,
+            f.file_id, f.source_name, f.filename,
+            caption=f"✅ {f.filename}"
+        )
+        if f.source_name != f.filename:
+            # Старая запись: дальше отдаём уже переименованный документ по file_id
+            f.file_id, f.source_name = sent.document.file_id, f.filename
+            storage.set_source(f.id, f.file_id, f.filename)
     except Exception as e:
         logger.error(e)
-        await update.callback_query.answer("❌ Ошибка", show_alert=True)
+        await bot.send_message(query.message.chat_id, f"❌ Ошибка при скачивании {f.filename}")
+
+@allowed(is_subscriber, "🔒 Статистика доступна только подписчикам.")
+async def popular_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = user_id_from_update(update)
+    await search_index.ensure_loaded()
+    top = search_index.popular(user_id, TOP_FILES)
+    files = {f.id: f for f in await storage.get_files([rid for rid, _ in top])}
+    msg = "🏆 Популярные файлы:\n\n"
+    kb = []
+    for place, (rid, n) in enumerate(top, 1):
+        f = files.get(rid)
+        if f:
+            msg += f"{place}. {f.filename} — ⬇️ {n}\n"
+            kb.append([InlineKeyboardButton(f"⬇️ {f.filename}", callback_data=f"download_{f.id}")])
+    if not kb:
+        msg = "📭 Пока никто ничего не скачивал."
+    await reply(update, msg, reply_markup=InlineKeyboardMarkup(kb))
 
 # ---------- ОБРАБОТКА ДОКУМЕНТОВ ----------
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -224,24 +1462,102 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("⚠️ Файл > 100 МБ.")
         return
 
+    # Альбом или второй документ до сохранения первого — пакетный режим
+    if 'batch' in context.user_data or update.message.media_group_id or 'file_id' in context.user_data:
+        await add_to_batch(update, context, doc)
+        return
+
     context.user_data.update({
         'file_id': doc.file_id,
+        'file_unique_id': doc.file_unique_id,
+        'file_size': doc.file_size,
+        'mime_type': doc.mime_type,
         'original_filename': doc.file_name,
         'original_extension': os.path.splitext(doc.file_name)[1],
         'new_extension': os.path.splitext(doc.file_name)[1]
     })
 
-    kb = [
-        [InlineKeyboardButton("✏️ Изменить имя", callback_data="change_name")],
-        [InlineKeyboardButton("🔄 Изменить расширение", callback_data="change_ext")],
-        [InlineKeyboardButton("✅ Сохранить как есть", callback_data="keep_as_is")],
-    ]
     await update.message.reply_text(
         f"📄 <b>{doc.file_name}</b>  |  {doc.file_size / 1024 / 1024:.2f} МБ\n\nВыберите действие:",
-        reply_markup=InlineKeyboardMarkup(kb),
+        reply_markup=FILE_MARKUP,
         parse_mode='HTML'
     )
 
+# ---------- ПАКЕТНАЯ ЗАГРУЗКА ----------
+# user_data['batch'] — список документов с теми же полями, что у одиночной
+# загрузки; new_name/new_extension задают общее правило для всех
+UPLOAD_FIELDS = ('file_id', 'file_unique_id', 'file_size', 'mime_type', 'original_filename')
+
+async def add_to_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, doc) -> None:
+    batch = context.user_data.get('batch')
+    if batch is None:
+        batch = context.user_data['batch'] = []
+        if 'file_id' in context.user_data:
+            # Первый документ уже ждёт кнопок — он становится началом пакета
+            batch.append({k: context.user_data.pop(k, None) for k in UPLOAD_FIELDS})
+        for k in ('original_extension', 'new_extension', 'new_name'):
+            context.user_data.pop(k, None)
+    if len(batch) >= BATCH_MAX_FILES:
+        if len(batch) == BATCH_MAX_FILES:
+            batch.append(None)  # предупреждаем один раз
+            await update.message.reply_text(f"⚠️ Не больше {BATCH_MAX_FILES} файлов за раз, остальные пропущены.")
+        return
+    batch.append({
+        'file_id': doc.file_id,
+        'file_unique_id': doc.file_unique_id,
+        'file_size': doc.file_size,
+        'mime_type': doc.mime_type,
+        'original_filename': doc.file_name,
+    })
+
+    # Меню — одно на пакет, когда документы перестали приходить
+    user_id = update.effective_user.id
+    timer = batch_timers.pop(user_id, None)
+    if timer:
+        timer.cancel()
+    batch_timers[user_id] = asyncio.create_task(
+        show_batch_menu_later(context.bot, update.effective_chat.id, user_id, context.user_data))
+
+async def show_batch_menu_later(bot, chat_id: int, user_id: int, user_data: dict) -> None:
+    try:
+        await asyncio.sleep(BATCH_WINDOW)
+        batch_timers.pop(user_id, None)
+        if 'batch' in user_data:
+            text, kb = batch_menu(user_data)
+            await bot.send_message(chat_id, text, reply_markup=kb, parse_mode='HTML')
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(e)
+
+def cancel_batch_timer(user_id: int) -> None:
+    timer = batch_timers.pop(user_id, None)
+    if timer:
+        timer.cancel()
+
+def batch_items(user_data: dict) -> list:
+    return [item for item in user_data['batch'] if item]
+
+def batch_names(user_data: dict) -> list:
+    # Общее имя получает номер: имя_1, имя_2, ...; расширение — общее или своё
+    name = user_data.get('new_name')
+    ext = user_data.get('new_extension')
+    names = []
+    for i, item in enumerate(batch_items(user_data), 1):
+        base, own_ext = os.path.splitext(item['original_filename'])
+        names.append(f"{f'{name}_{i}' if name else base}{ext or own_ext}")
+    return names
+
+def preview(names: list) -> str:
+    text = "\n".join(f"• {n}" for n in names[:BATCH_PREVIEW])
+    if len(names) > BATCH_PREVIEW:
+        text += f"\n… и ещё {len(names) - BATCH_PREVIEW}"
+    return text
+
+def batch_menu(user_data: dict) -> tuple:
+    names = batch_names(user_data)
+    return f"📦 <b>Файлов в пакете: {len(names)}</b>\n\n{preview(names)}", BATCH_MARKUP
+
 # ---------- ОБРАБОТКА ТЕКСТА ----------
 async def handle_filename(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.user_data.get('state') != WAITING_FOR_NAME:
@@ -251,15 +1567,14 @@ async def handle_filename(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Имя не может быть пустым.")
         return
     context.user_data['new_name'] = name
+    if 'batch' in context.user_data:
+        text, kb = batch_menu(context.user_data)
+        await update.message.reply_text(text, reply_markup=kb, parse_mode='HTML')
+        return
     ext = context.user_data['new_extension']
-    kb = [
-        [InlineKeyboardButton("✅ Сохранить", callback_data="confirm_save")],
-        [InlineKeyboardButton("✏️ Изменить имя", callback_data="change_name")],
-        [InlineKeyboardButton("🔄 Изменить расширение", callback_data="change_ext")],
-    ]
     await update.message.reply_text(
         f"📄 Новое имя: <b>{name}{ext}</b>",
-        reply_markup=InlineKeyboardMarkup(kb),
+        reply_markup=RENAMED_MARKUP,
         parse_mode='HTML'
     )
 
@@ -273,183 +1588,818 @@ async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         context.user_data['state'] = WAITING_FOR_FILE
         return
 
-    found = [f for uid, files in user_files.items() if uid != user_id
-             for f in files if f.get('public', True) and query in f['filename'].lower()]
+    await search_index.ensure_loaded()
+    found = search_index.search(query, user_id)
     if not found:
         await update.message.reply_text("❌ Ничего не найдено")
         context.user_data['state'] = WAITING_FOR_FILE
         return
 
-    file_search_cache[user_id] = [found, 0]
-    await show_files_page(update, context, user_id, 0)
+    ids = file_search_cache.put(user_id, found)
+    if storage.shared:
+        storage.save_search(user_id, ids)
+    await show_files_page(update, context, user_id, SEARCH)
+
+# Текст без команды разбирается по состоянию диалога
+TEXT_HANDLERS = {WAITING_FOR_NAME: handle_filename, WAITING_FOR_SEARCH: handle_search}
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    handler = TEXT_HANDLERS.get(context.user_data.get('state'))
+    if handler:
+        await handler(update, context)
 
 # ---------- СОХРАНЕНИЕ ----------
 async def process_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
+    upload = dict(context.user_data)
+    if 'batch' in upload:
+        cancel_batch_timer(user_id)
+        context.user_data.clear()
+        context.user_data['state'] = WAITING_FOR_FILE
+        await save_batch(query, user_id, batch_items(upload), batch_names(upload))
+        return
     try:
-        file_id = context.user_data['file_id']
-        new_name = context.user_data.get('new_name', os.path.splitext(context.user_data['original_filename'])[0])
-        new_ext = context.user_data.get('new_extension', context.user_data['original_extension'])
-        new_filename = f"{new_name}{new_ext}"
-
-        file = await context.bot.get_file(file_id)
-        path = await file.download_to_drive()
-        new_path = os.path.join(os.path.dirname(path), new_filename)
-        os.rename(path, new_path)
-
-        with open(new_path, 'rb') as fp:
-            await context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=fp,
-                filename=new_filename,
+        file_id = upload['file_id']
+        new_name = upload.get('new_name', os.path.splitext(upload['original_filename'])[0])
+        new_ext = upload.get('new_extension', upload['original_extension'])
+    except KeyError as e:
+        logger.error(e)
+        await query.edit_message_text("⚠️ Ошибка при обработке файла.")
+        return
+    new_filename = f"{new_name}{new_ext}"
+
+    # Состояние сбрасывается сразу: пересылка идёт в пуле, а следующий файл
+    # можно отправлять, не дожидаясь её
+    context.user_data.clear()
+    context.user_data['state'] = WAITING_FOR_FILE
+    transfers.submit(save_upload(context, query, user_id, file_id, new_filename, upload), user_id)
+
+async def save_upload(context: ContextTypes.DEFAULT_TYPE, query, user_id: int, file_id: str,
+                      new_filename: str, upload: dict) -> None:
+    try:
+        unique_id = upload.get('file_unique_id')
+        blob = await storage.find_blob(unique_id) if unique_id else None
+        own = await get_user_files(user_id)
+        if blob:
+            # Такое содержимое уже есть: новая запись — псевдоним с общим file_id,
+            # файл не пересылается, переименование — при первом скачивании
+            if any(f.blob == blob.blob and f.filename == new_filename for f in own):
+                await query.edit_message_text(f"ℹ️ {new_filename} уже есть среди ваших файлов.")
+                return
+            rid, = await storage.new_ids(1)
+            rec = FileRecord(
+                rid, user_id, blob.file_id, new_filename, True, time.time(),
+                blob.size, blob.mime, blob.source_name, blob.blob
+            )
+        else:
+            sent = await send_stored_file(
+                context.bot, query.message.chat_id,
+                file_id, upload['original_filename'], new_filename,
                 caption=f"✅ Сохранено: {new_filename}",
                 parse_mode='HTML'
             )
-
-        user_files.setdefault(user_id, []).append({
-            "file_id": file_id,
-            "filename": new_filename,
-            "public": True,
-            "timestamp": datetime.now()
-        })
-        os.remove(new_path)
-        context.user_data.clear()
-        context.user_data['state'] = WAITING_FOR_FILE
-        await query.delete_message()
+            # file_id отправленного документа уже несёт новое имя
+            rid, = await storage.new_ids(1)
+            rec = FileRecord(
+                rid, user_id, sent.document.file_id, new_filename, True, time.time(),
+                upload.get('file_size'), upload.get('mime_type'), new_filename
+            )
+        own.append(rec)
+        privacy_pages.appended(user_id, len(own) - 1)
+        storage.save_file(rec, unique_id)
+        search_index.add(rec.id, user_id, new_filename, rec.blob)
+        if blob:
+            await query.edit_message_text(f"✅ Сохранено: {new_filename}")
+        else:
+            await query.delete_message()
     except Exception as e:
         logger.error(e)
+        if 'file_id' not in context.user_data:
+            # Новый файл ещё не начат — сохранение можно повторить той же кнопкой
+            context.user_data.update(upload)
         await query.edit_message_text("⚠️ Ошибка при обработке файла.")
 
+async def save_batch(query, user_id: int, batch: list, names: list) -> None:
+    # Пакет не пересылается: записи ссылаются на file_id присланных документов,
+    # новое имя файл получит при первом скачивании. Одно чтение из storage
+    # на весь пакет и одно итоговое сообщение.
+    try:
+        blobs = await storage.find_blobs([item['file_unique_id'] for item in batch if item['file_unique_id']])
+        own = await get_user_files(user_id)
+        existing = {(f.blob, f.filename) for f in own}
+        ids = iter(await storage.new_ids(len(batch)))
+        saved, skipped = [], []
+        now = time.time()
+        for item, name in zip(batch, names):
+            unique_id = item['file_unique_id']
+            blob = blobs.get(unique_id)
+            if blob and (blob.blob, name) in existing:
+                skipped.append(name)
+                continue
+            if blob:
+                rec = FileRecord(next(ids), user_id, blob.file_id, name, True, now,
+                                 blob.size, blob.mime, blob.source_name, blob.blob)
+            else:
+                rec = FileRecord(next(ids), user_id, item['file_id'], name, True, now,
+                                 item['file_size'], item['mime_type'], item['original_filename'])
+                if unique_id:
+                    blobs[unique_id] = rec
+            existing.add((rec.blob, name))
+            own.append(rec)
+            privacy_pages.appended(user_id, len(own) - 1)
+            storage.save_file(rec, unique_id)
+            search_index.add(rec.id, user_id, name, rec.blob)
+            saved.append(name)
+    except Exception as e:
+        logger.error(e)
+        await query.edit_message_text("⚠️ Ошибка при сохранении пакета.")
+        return
+
+    text = f"✅ Сохранено файлов: {len(saved)}"
+    if saved:
+        text += f"\n\n{preview(saved)}"
+    if skipped:
+        text += f"\n\nℹ️ Уже были среди ваших файлов: {len(skipped)}"
+    await query.edit_message_text(text)
+
 # ---------- АДМИН ----------
+@allowed(is_admin, "❌ Недостаточно прав")
 async def admin_add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
-        await update.message.reply_text("❌ Недостаточно прав")
-        return
     if not context.args:
         await update.message.reply_text("Использование: /add_subscription <user_id>")
         return
     try:
         target = int(context.args[0])
         subscribed_users.add(target)
+        storage.add_subscription(target)
         await update.message.reply_text(f"✅ Пользователю {target} добавлена подписка")
     except ValueError:
         await update.message.reply_text("❌ Неверный ID")
 
 # ---------- ОБРАБОТКА КНОПОК ----------
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = query.from_user.id
+class Route:
+    __slots__ = ('name', 'inner', 'handler', 'parse', 'stale')
 
-    # Навигация / скачивание
-    if data.startswith("download_"):
-        await download_file(update, context, int(data[9:]))
-    elif data.startswith("page_"):
-        page = int(data[5:])
-        file_search_cache[user_id][1] = page
-        await show_files_page(update, context, user_id, page)
-    elif data == "new_search":
-        await search_files(query, context)
-
-    # Работа с файлом
-    elif data == "change_name":
-        await query.edit_message_text("✏️ Введите новое имя файла (без расширения):")
-        context.user_data['state'] = WAITING_FOR_NAME
-    elif data == "change_ext":
-        kb = [[InlineKeyboardButton(ext, callback_data=f"set_ext{ext}")] for ext in ALLOWED_EXTENSIONS]
-        kb.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
-        await query.edit_message_text("🔄 Выберите новое расширение:", reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("set_ext"):
-        context.user_data['new_extension'] = data[7:]
-        name = context.user_data.get('new_name', os.path.splitext(context.user_data['original_filename'])[0])
-        kb = [
-            [InlineKeyboardButton("✏️ Изменить имя", callback_data="change_name")],
-            [InlineKeyboardButton("🔄 Изменить расширение", callback_data="change_ext")],
-            [InlineKeyboardButton("✅ Сохранить", callback_data="confirm_save")],
-        ]
-        await query.edit_message_text(
-            f"📄 Новое имя файла: <b>{name}{data[7:]}</b>",
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode='HTML'
-        )
-    elif data in ["keep_as_is", "confirm_save"]:
-        await process_file(update, context)
-    elif data == "back_to_main":
-        kb = [
-            [InlineKeyboardButton("✏️ Изменить имя", callback_data="change_name")],
-            [InlineKeyboardButton("🔄 Изменить расширение", callback_data="change_ext")],
-            [InlineKeyboardButton("✅ Сохранить как есть", callback_data="keep_as_is")],
-        ]
-        await query.edit_message_text(
-            f"📄 Файл: <b>{context.user_data['original_filename']}</b>",
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode='HTML'
-        )
+    def __init__(self, name: str, inner, parse, stale: str):
+        self.name = name
+        self.inner = inner      # обработчик с middleware маршрута
+        self.handler = inner    # он же с замером времени, см. CallbackRouter.instrument
+        self.parse = parse
+        self.stale = stale
 
-    # Приватность
-    elif data == "set_all_public":
-        for f in user_files.get(user_id, []):
-            f['public'] = True
-        await query.edit_message_text("✅ Все файлы теперь публичные")
-    elif data == "set_all_private":
-        for f in user_files.get(user_id, []):
-            f['public'] = False
-        await query.edit_message_text("✅ Все файлы теперь приватные")
-    elif data == "manage_individual":
-        files = user_files.get(user_id, [])
-        msg = "📋 Ваши файлы:\n\n"
-        kb = []
-        for i, f in enumerate(files, 1):
-            status = "🔓" if f['public'] else "🔒"
-            msg += f"{i}. {status} {f['filename']}\n"
-            kb.append([InlineKeyboardButton(
-                f"{'Скрыть' if f['public'] else 'Показать'} {f['filename']}",
-                callback_data=f"toggle_{i - 1}")])
-        kb.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_privacy")])
-        await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("toggle_"):
-        idx = int(data[7:])
-        files = user_files.get(user_id, [])
-        if 0 <= idx < len(files):
-            files[idx]['public'] ^= True
-            status = "публичный" if files[idx]['public'] else "приватный"
-            await query.edit_message_text(f"✅ Файл теперь {status}")
-    elif data == "back_to_privacy":
-        await toggle_privacy(query, context)
-
-    # Команды из /start
-    elif data == "cmd_subscribe":
-        await subscription_info(query, context)
-        await query.delete_message()
-    elif data == "cmd_privacy":
-        await toggle_privacy(query, context)
-        await query.delete_message()
-    elif data == "cmd_browse":
-        await browse_files(query, context)
-        await query.delete_message()
-    elif data == "cmd_search":
-        await search_files(query, context)
-        await query.delete_message()
+class CallbackRouter:
+    # callback_data -> обработчик. Точные значения ищутся в словаре, параметризованные
+    # (download_<id>, page_..., toggle_<i>, set_ext<ext>) — по самому длинному префиксу
+    # в дереве по символам, так что поиск не зависит от числа маршрутов. Остаток
+    # строки parse маршрута превращает в аргументы обработчика; ValueError из parse
+    # означает старую или подделанную кнопку.
+    STALE = "❌ Кнопка устарела."
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._routes = []
+
+    def add(self, data: str, handler, parse=None, middleware=(), answer: bool = True, stale: str = STALE) -> None:
+        # answer=False — обработчик сам отвечает на нажатие (например, всплывающим окном)
+        for mw in reversed(middleware):
+            handler = mw(handler)
+        if answer:
+            handler = answered(handler)
+        route = Route(data, handler, parse, stale)
+        self._routes.append(route)
+        if parse is None:
+            self._exact[data] = route
+            return
+        node = self._prefixes
+        for ch in data:
+            node = node.setdefault(ch, {})
+        node[''] = route
+
+    def instrument(self, timed) -> None:
+        for route in self._routes:
+            route.handler = timed(f"button:{route.name}", route.inner)
+
+    def resolve(self, data: str) -> tuple:
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        node, end = self._prefixes, 0
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if '' in node:
+                route, end = node[''], i + 1
+        return route, data[end:]
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        route, rest = self.resolve(query.data or "")
+        if route is None:
+            logger.warning(f"unknown callback: {query.data!r}")
+            await query.answer()
+            return
+        try:
+            args = route.parse(rest) if route.parse else ()
+        except ValueError:
+            await query.answer()
+            await query.message.reply_text(route.stale)
+            return
+        await route.handler(update, context, *args)
+
+def answered(handler):
+    async def wrapper(update, context, *args):
+        await update.callback_query.answer()
+        return await handler(update, context, *args)
+    return wrapper
+
+def from_start(handler):
+    # Кнопки меню /start: ответ приходит новым сообщением, меню убирается
+    async def wrapper(update, context, *args):
+        await handler(update, context, *args)
+        await update.callback_query.delete_message()
+    return wrapper
+
+def int_arg(s: str) -> tuple:
+    return (int(s),)
+
+def page_args(s: str) -> tuple:
+    m = PAGE_RE.fullmatch(s)
+    if not m:
+        raise ValueError(s)
+    kind, page, op, rid = m.groups()
+    return kind, int(page), (op, int(rid)) if op else None
+
+def ext_arg(s: str) -> tuple:
+    if s not in ALLOWED_EXTENSIONS:
+        raise ValueError(s)
+    return (s,)
+
+async def open_page(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, page: int, cursor) -> None:
+    await show_files_page(update, context, user_id_from_update(update), kind, page, cursor)
+
+async def ask_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if 'batch' in context.user_data:
+        await update.callback_query.edit_message_text("✏️ Введите общее имя (файлы получат имя_1, имя_2, ...):")
+    else:
+        await update.callback_query.edit_message_text("✏️ Введите новое имя файла (без расширения):")
+    context.user_data['state'] = WAITING_FOR_NAME
+
+async def ask_extension(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.edit_message_text("🔄 Выберите новое расширение:", reply_markup=EXT_MARKUP)
+
+async def set_extension(update: Update, context: ContextTypes.DEFAULT_TYPE, ext: str) -> None:
+    context.user_data['new_extension'] = ext
+    if 'batch' in context.user_data:
+        text, kb = batch_menu(context.user_data)
+        await update.callback_query.edit_message_text(text, reply_markup=kb, parse_mode='HTML')
+        return
+    name = context.user_data.get('new_name', os.path.splitext(context.user_data['original_filename'])[0])
+    await update.callback_query.edit_message_text(
+        f"📄 Новое имя файла: <b>{name}{ext}</b>",
+        reply_markup=NEW_EXT_MARKUP,
+        parse_mode='HTML'
+    )
+
+async def back_to_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if 'batch' in context.user_data:
+        text, kb = batch_menu(context.user_data)
+        await update.callback_query.edit_message_text(text, reply_markup=kb, parse_mode='HTML')
+        return
+    await update.callback_query.edit_message_text(
+        f"📄 Файл: <b>{context.user_data['original_filename']}</b>",
+        reply_markup=FILE_MARKUP,
+        parse_mode='HTML'
+    )
+
+async def cancel_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cancel_batch_timer(user_id_from_update(update))
+    context.user_data.clear()
+    context.user_data['state'] = WAITING_FOR_FILE
+    await update.callback_query.edit_message_text("❌ Пакет отменён.")
+
+async def set_all_privacy(update: Update, context: ContextTypes.DEFAULT_TYPE, public: bool) -> None:
+    user_id = user_id_from_update(update)
+    files = await get_user_files(user_id)
+    for f in files:
+        f.public = public
+        if public:
+            search_index.add(f.id, user_id, f.filename, f.blob)
+        else:
+            search_index.discard(f.id)
+    storage.set_public([f.id for f in files], public)
+    privacy_pages.reset(user_id)
+    await update.callback_query.edit_message_text(
+        "✅ Все файлы теперь публичные" if public else "✅ Все файлы теперь приватные")
+
+async def show_privacy_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0) -> None:
+    user_id = user_id_from_update(update)
+    files = await get_user_files(user_id)
+    if not files:
+        await update.callback_query.edit_message_text("У вас еще нет загруженных файлов.")
+        return
+    text, kb = privacy_pages.get(user_id, files, page)
+    await update.callback_query.edit_message_text(text, reply_markup=kb)
+
+async def toggle_file(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int) -> None:
+    user_id = user_id_from_update(update)
+    files = await get_user_files(user_id)
+    if not 0 <= idx < len(files):
+        return
+    f = files[idx]
+    f.public ^= True
+    if f.public:
+        search_index.add(f.id, user_id, f.filename, f.blob)
+    else:
+        search_index.discard(f.id)
+    storage.set_public([f.id], f.public)
+    # Перерисовывается только страница с этим файлом
+    privacy_pages.changed(user_id, idx)
+    text, kb = privacy_pages.get(user_id, files, idx // PRIVACY_PAGE)
+    await update.callback_query.edit_message_text(text, reply_markup=kb)
+
+callbacks = CallbackRouter()
+# Навигация / скачивание; download_file отвечает сам: местом в очереди или причиной отказа
+callbacks.add("download_", download_file, parse=int_arg, answer=False,
+              middleware=(allowed(is_subscriber, "❌ Файл недоступен", alert=True),))
+callbacks.add("page_", open_page, parse=page_args, stale="❌ Результаты устарели.",
+              middleware=(allowed(is_subscriber, "🔒 Доступно только подписчикам."),))
+callbacks.add("new_search", search_files)
+# Работа с файлом
+callbacks.add("change_name", ask_name)
+callbacks.add("change_ext", ask_extension)
+callbacks.add("set_ext", set_extension, parse=ext_arg)
+callbacks.add("keep_as_is", process_file)
+callbacks.add("confirm_save", process_file)
+callbacks.add("back_to_main", back_to_file)
+callbacks.add("batch_cancel", cancel_batch)
+# Приватность
+callbacks.add("set_all_public", lambda u, c: set_all_privacy(u, c, True))
+callbacks.add("set_all_private", lambda u, c: set_all_privacy(u, c, False))
+callbacks.add("manage_individual", show_privacy_page)
+callbacks.add("privacy_", show_privacy_page, parse=int_arg)
+callbacks.add("toggle_", toggle_file, parse=int_arg)
+callbacks.add("back_to_privacy", toggle_privacy)
+# Команды из /start
+callbacks.add("cmd_subscribe", subscription_info, middleware=(from_start,))
+callbacks.add("cmd_privacy", toggle_privacy, middleware=(from_start,))
+callbacks.add("cmd_browse", browse_files, middleware=(from_start,))
+callbacks.add("cmd_search", search_files, middleware=(from_start,))
+
+button_callback = callbacks.dispatch
+
+# ---------- МЕТРИКИ ----------
+class Metrics:
+    # Гистограммы задержек обработчиков и вызовов Bot API, счётчики ошибок и байт.
+    # Выключены, если не задан ни METRICS_PORT, ни METRICS_LOG_INTERVAL:
+    # тогда обработчики и запросы регистрируются без обёрток.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        # (метрика, метка) -> [счётчики по корзинам..., сумма, число, ошибки]
+        self._hist = {}
+        self._bytes = {}  # (метод, направление) -> байт
+
+    def observe(self, metric: str, label: str, seconds: float, error: bool = False) -> None:
+        entry = self._hist.get((metric, label))
+        if entry is None:
+            entry = self._hist[(metric, label)] = [0] * (len(self.BUCKETS) + 3)
+        entry[bisect_left(self.BUCKETS, seconds)] += 1
+        entry[-3] += seconds
+        entry[-2] += 1
+        if error:
+            entry[-1] += 1
+
+    def add_bytes(self, method: str, direction: str, n: int) -> None:
+        if n:
+            self._bytes[(method, direction)] = self._bytes.get((method, direction), 0) + n
+
+    def quantile(self, entry: list, q: float) -> float:
+        # Верхняя граница корзины, в которую попадает q-я доля наблюдений
+        rank, seen = q * entry[-2], 0
+        for bound, n in zip(self.BUCKETS, entry):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.BUCKETS[-1]
+
+    def timed(self, name: str, handler):
+        if not self.enabled:
+            return handler
+
+        async def wrapper(update, context, *args):
+            started = time.perf_counter()
+            error = True
+            try:
+                result = await handler(update, context, *args)
+                error = False
+                return result
+            finally:
+                self.observe("handler", name, time.perf_counter() - started, error)
+        return wrapper
+
+    def render(self) -> str:
+        # Текстовый формат Prometheus
+        lines = []
+        names = {"handler": ("bot_handler_seconds", "handler"), "api": ("bot_api_seconds", "method")}
+        for metric, (name, key) in names.items():
+            lines.append(f"# TYPE {name} histogram")
+            errors = []
+            for (m, label), entry in sorted(self._hist.items()):
+                if m != metric:
+                    continue
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS, entry):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'{name}_bucket{{{key}="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{key}="{label}"}} {entry[-3]:.6f}')
+                lines.append(f'{name}_count{{{key}="{label}"}} {entry[-2]}')
+                errors.append(f'{name[:-8]}_errors_total{{{key}="{label}"}} {entry[-1]}')
+            lines.append(f"# TYPE {name[:-8]}_errors_total counter")
+            lines.extend(errors)
+        lines.append("# TYPE bot_api_bytes_total counter")
+        for (method, direction), n in sorted(self._bytes.items()):
+            lines.append(f'bot_api_bytes_total{{method="{method}",direction="{direction}"}} {n}')
+        # sessions и bytes — текущие значения, остальное только растёт
+        for key, value in file_search_cache.stats().items():
+            name, kind = ((f"bot_search_cache_{key}", "gauge") if key in ("sessions", "bytes")
+                          else (f"bot_search_cache_{key}_total", "counter"))
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        lines.append("# TYPE bot_transfers_active gauge")
+        lines.append(f"bot_transfers_active {transfers.active()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        # Коротко для лога: число, ошибки, p50/p99 (по границам корзин), среднее
+        parts = []
+        for (metric, label), entry in sorted(self._hist.items()):
+            if entry[-2]:
+                parts.append(
+                    f"{metric}:{label} n={entry[-2]} err={entry[-1]} "
+                    f"avg={entry[-3] / entry[-2] * 1000:.0f}ms "
+                    f"p50<={self.quantile(entry, 0.5)}s p99<={self.quantile(entry, 0.99)}s"
+                )
+        parts.extend(f"bytes:{method}:{direction}={n}" for (method, direction), n in sorted(self._bytes.items()))
+        return "; ".join(parts) or "нет данных"
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Любой GET отдаёт метрики; тело запроса не читаем
+        try:
+            await reader.readline()
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def log_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"metrics: {self.summary()}")
+
+metrics = Metrics(bool(METRICS_PORT or METRICS_LOG_INTERVAL))
+
+class InstrumentedRequest(BaseRequest):
+    # Обёртка над транспортом Bot API: время, ошибки и байты по методам.
+    # Скачивание файлов (download_to_memory/download_to_drive) идёт как "download".
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    @staticmethod
+    def part_size(content) -> int:
+        # Файл, переданный открытым (read_file_handle=False), меряем без чтения
+        if isinstance(content, (bytes, bytearray)):
+            return len(content)
+        pos = content.tell()
+        size = content.seek(0, os.SEEK_END)
+        content.seek(pos)
+        return size
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> tuple:
+        api_method = "download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        if request_data is not None and request_data.contains_files:
+            sent = sum(self.part_size(part[1]) for part in request_data.multipart_data.values())
+            metrics.add_bytes(api_method, "out", sent)
+        started = time.perf_counter()
+        code = 0
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **kwargs)
+        finally:
+            metrics.observe("api", api_method, time.perf_counter() - started, not 200 <= code < 300)
+        metrics.add_bytes(api_method, "in", len(payload))
+        return code, payload
+
+# ---------- НЕСКОЛЬКО ПРОЦЕССОВ ----------
+# BOT_WORKERS > 1: основной процесс только получает обновления и раскладывает
+# их по очередям процессов-обработчиков по user_id, так что пользователь всегда
+# попадает в один и тот же процесс, а его user_data, лимиты и пересылки остаются
+# локальными. Общее состояние — в DB_PATH: каталог и подписки (изменения
+# других процессов читаются из журнала changes), сессии поиска и user_data.
+class SQLitePersistence(BasePersistence):
+    # user_data пользователей своего процесса в таблице user_data: перезапущенный
+    # процесс продолжает начатые диалоги (переименование, пакет). Остальное не хранится.
+    def __init__(self, path: str, shard: int, workers: int):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+                         update_interval=PERSIST_INTERVAL)
+        self.path = path
+        self.shard = shard
+        self.workers = workers
+        self.conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        if self.conn is None:
+            # Открывается раньше storage: PTB читает user_data до post_init
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        with self.conn:
+            return self.conn.execute(sql, params).fetchall()
+
+    async def get_user_data(self) -> dict:
+        rows = await self._run(self._execute, "SELECT user_id, data FROM user_data WHERE user_id % ? = ?",
+                               (self.workers, self.shard))
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._run(self._execute, "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                        (user_id, json.dumps(data)))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._run(self._execute, "DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self.conn is not None:
+            await self._run(self.conn.close)
+        self._executor.shutdown()
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+async def follow_changes(seq: int) -> None:
+    # Файлы, скачивания и подписки из других процессов переносятся в индекс
+    # поиска и subscribed_users; заодно чистится старый журнал
+    prune_at = 0.0
+    while True:
+        await asyncio.sleep(SHARED_REFRESH)
+        try:
+            rows = await storage.changes_since(seq)
+            if rows:
+                seq = rows[-1][0]
+            files = {}
+            for _, kind, key in rows:
+                if kind == 'file':
+                    files[key] = None
+                elif kind == 'download':
+                    search_index.record_download(key)
+                elif kind == 'sub':
+                    subscribed_users.add(key)
+            if files:
+                # Публичность берётся текущая, а не из журнала
+                for f in await storage.get_files(list(files)):
+                    files[f.id] = f
+                for rid, f in files.items():
+                    if f and f.public:
+                        search_index.add(f.id, f.owner, f.filename, f.blob)
+                    else:
+                        search_index.discard(rid)
+            if time.monotonic() >= prune_at:
+                storage.prune(time.time() - SHARED_LOG_TTL)
+                prune_at = time.monotonic() + 60
+        except sqlite3.Error as e:
+            logger.error(f"shared: изменения не прочитаны: {e}")
+
+def shard_of(update: Update, workers: int) -> int:
+    user = update.effective_user
+    return user.id % workers if user else 0
+
+def run_worker(shard: int, workers: int, queue) -> None:
+    # Останавливается диспетчером через очередь, а не Ctrl+C всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += shard
+    temp_files.quota = TEMP_QUOTA // workers
+    buffers.quota = BUFFER_QUOTA // workers
+    storage.share(shard)
+    app = build_app(make_builder().persistence(SQLitePersistence(DB_PATH, shard, workers)))
+    logger.info(f"worker {shard}/{workers} started")
+    asyncio.run(serve_shard(app, queue))
+
+async def serve_shard(app: Application, queue) -> None:
+    # Обновления из очереди диспетчера (JSON; None — остановка)
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        while (data := await loop.run_in_executor(None, queue.get)) is not None:
+            await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+def forwarder(queues: list):
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        queues[shard_of(update, len(queues))].put(update.to_json())
+    return forward
+
+def run_dispatcher(workers: int) -> None:
+    ctx = multiprocessing.get_context('spawn')
+    # Очереди живут в этом процессе: обновления упавшего обработчика ждут его перезапуска
+    queues = [ctx.Queue() for _ in range(workers)]
+
+    def start_worker(shard: int):
+        proc = ctx.Process(target=run_worker, args=(shard, workers, queues[shard]), name=f"worker-{shard}")
+        proc.start()
+        return proc
+
+    procs = [start_worker(shard) for shard in range(workers)]
+
+    async def supervise() -> None:
+        while True:
+            await asyncio.sleep(1)
+            for shard, proc in enumerate(procs):
+                if not proc.is_alive():
+                    logger.warning(f"worker {shard} exited with code {proc.exitcode}, restarting")
+                    procs[shard] = start_worker(shard)
+
+    async def post_init(app: Application) -> None:
+        app.bot_data['supervisor'] = asyncio.create_task(supervise())
+
+    async def post_shutdown(app: Application) -> None:
+        app.bot_data['supervisor'].cancel()
+        for q in queues:
+            q.put(None)
+        for proc in procs:
+            await asyncio.get_running_loop().run_in_executor(None, proc.join)
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    app.add_handler(TypeHandler(Update, forwarder(queues)))
+    run_app(app)
 
 # ---------- RUN ----------
-def main() -> None:
-    app = ApplicationBuilder().token("8244258907:AAGSOfk1CMoBku1ChaL-lTEjWdFG7ll_EYo").build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("subscribe", subscription_info))
-    app.add_handler(CommandHandler("privacy", toggle_privacy))
-    app.add_handler(CommandHandler("browse", browse_files))
-    app.add_handler(CommandHandler("search", search_files))
-    app.add_handler(CommandHandler("add_subscription", admin_add_subscription))
-    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: (
-        handle_filename(u, c) if c.user_data.get('state') == WAITING_FOR_NAME else
-        handle_search(u, c)   if c.user_data.get('state') == WAITING_FOR_SEARCH else None
-    )))
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно, одного —
+    # строго по очереди, чтобы user_data['state'] не перемешивался.
+    # Ожидающие своей очереди не занимают слоты max_concurrent.
+    def __init__(self, max_concurrent: int, max_pending: int):
+        super().__init__(max_pending)
+        self._active = asyncio.Semaphore(max_concurrent)
+        self._users = {}  # user_id -> [Lock, число обновлений в очереди]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._active:
+                await coroutine
+            return
+
+        entry = self._users.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._active:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def on_startup(app: Application) -> None:
+    await storage.open()
+    await temp_files.open()
+    if storage.shared:
+        # Журнал читается с момента до загрузки подписок: ничего не теряется
+        app.bot_data['follower'] = asyncio.create_task(follow_changes(await storage.last_change()))
+    subscribed_users.update(await storage.load_subscriptions())
+    search_index.start()
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = await asyncio.start_server(metrics.serve, port=METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        app.bot_data['metrics_log'] = asyncio.create_task(metrics.log_loop(METRICS_LOG_INTERVAL))
+
+async def on_shutdown(app: Application) -> None:
+    await transfers.shutdown()
+    search_index.stop()
+    if 'follower' in app.bot_data:
+        app.bot_data['follower'].cancel()
+    logger.info(f"search cache: {file_search_cache.stats()}")
+    if 'metrics_log' in app.bot_data:
+        app.bot_data['metrics_log'].cancel()
+    if 'metrics_server' in app.bot_data:
+        app.bot_data['metrics_server'].close()
+    if metrics.enabled:
+        logger.info(f"metrics: {metrics.summary()}")
+    await temp_files.close()
+    await storage.close()
+
+def build_app(builder: ApplicationBuilder) -> Application:
+    app = (
+        builder
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", metrics.timed("start", start)))
+    app.add_handler(CommandHandler("subscribe", metrics.timed("subscription_info", subscription_info)))
+    app.add_handler(CommandHandler("privacy", metrics.timed("toggle_privacy", toggle_privacy)))
+    app.add_handler(CommandHandler("browse", metrics.timed("browse_files", browse_files)))
+    app.add_handler(CommandHandler("search", metrics.timed("search_files", search_files)))
+    app.add_handler(CommandHandler("top", metrics.timed("popular_files", popular_files)))
+    app.add_handler(CommandHandler("add_subscription", metrics.timed("admin_add_subscription", admin_add_subscription)))
+    app.add_handler(MessageHandler(filters.Document.ALL, metrics.timed("handle_document", handle_document)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, metrics.timed("text", handle_text)))
+    # Время кнопок меряется по маршрутам: button:<callback_data или префикс>
+    callbacks.instrument(metrics.timed)
     app.add_handler(CallbackQueryHandler(button_callback))
-    app.run_polling()
+    return app
+
+def make_builder() -> ApplicationBuilder:
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if metrics.enabled:
+        # Те же параметры пула, что ApplicationBuilder ставит по умолчанию
+        builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+    return builder
+
+def run_app(app: Application) -> None:
+    if BOT_MODE == 'webhook':
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
+
+def main() -> None:
+    if WORKERS > 1:
+        run_dispatcher(WORKERS)
+    else:
+        run_app(build_app(make_builder()))
 
 if __name__ == '__main__':
     main()
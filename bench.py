@@ -0,0 +1,500 @@
+# ---------- ЗАМЕРЫ ----------
+# Офлайн-бенчмарки бота, сеть не нужна.
+#   python bench.py records [-n 1000000]   — память на одну запись файла
+#   python bench.py search [-n 100000 1000000]  — построение индекса и задержка запросов;
+#       с несколькими размерами сравнивает их и проверяет бюджет на самом большом
+#   python bench.py render [--files 200]   — построение меню: каждый раз против готовых
+#   python bench.py load [--files 10000 --users 1000 --updates 5000 ...]
+#       — нагрузка на настоящие обработчики через заглушку Bot API
+import argparse
+import asyncio
+import gc
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+
+def load_bot():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1.py")
+    spec = importlib.util.spec_from_file_location("bot", path)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    # Текущий, а не пиковый RSS (Linux)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+# ---------- ПАМЯТЬ НА ЗАПИСЬ ----------
+def synthetic_fields(bot, n: int) -> list:
+    exts = bot.ALLOWED_EXTENSIONS
+    now = time.time()
+    return [
+        (i + 1, 1_000_000 + i % 50_000, f"BQACAgIAAxkBAAIBa2{i:012d}AAHrYRBc", f"file_{i}{exts[i % len(exts)]}",
+         now - i, 1024 + i, "application/octet-stream")
+        for i in range(n)
+    ]
+
+
+def as_dicts(bot, fields: list) -> list:
+    # Формат записей до FileRecord
+    return [{
+        "id": rid,
+        "file_id": file_id,
+        "filename": filename,
+        "public": True,
+        "timestamp": datetime.fromtimestamp(ts),
+        "size": size,
+        "mime": mime,
+        "source_name": filename,
+        "owner": owner,
+    } for rid, owner, file_id, filename, ts, size, mime in fields]
+
+
+def as_records(bot, fields: list) -> list:
+    return [bot.FileRecord(rid, owner, file_id, filename, True, ts, size, mime, filename)
+            for rid, owner, file_id, filename, ts, size, mime in fields]
+
+
+def bench_records(args) -> None:
+    bot = load_bot()
+    # Строки и числа создаются заранее: оба варианта ссылаются на одни и те же
+    # объекты, замер показывает стоимость самой записи
+    fields = synthetic_fields(bot, args.n)
+    print(f"records: {args.n}")
+    for name, build in (("dict", as_dicts), ("FileRecord", as_records)):
+        tracemalloc.start()
+        records = build(bot, fields)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        print(f"{name:<12}{used / args.n:8.1f} bytes/record")
+
+
+# ---------- ПОИСК ----------
+SYLLABLES = ["ka", "ro", "mi", "sta", "ne", "lo", "vi", "tra", "bu", "ze", "gor", "pan", "dex", "quo", "fi"]
+
+
+def search_latency(bot, args, n: int, vocab: list) -> dict:
+    # Индекс из n имён: память и задержки запросов каждого вида
+    rng = random.Random(args.seed)
+    names = ["_".join(rng.sample(vocab, 2)) + rng.choice(bot.ALLOWED_EXTENSIONS) for _ in range(n)]
+    gc.collect()
+    before = current_rss_mb()
+    index = bot.SearchIndex()
+    t = time.perf_counter()
+    for i, name in enumerate(names, 1):
+        index._add(i, i % 50_000, name, i)
+    for i in rng.sample(range(1, n + 1), min(n, n // 10 + 1)):
+        index._record_download(i)
+    built = time.perf_counter() - t
+    gc.collect()
+    used = current_rss_mb() - before
+    entries = sum(len(ids) for ids in index.postings.lists.values())
+    print(f"index: {n} names, {len(index.tokens.lists)} words, built in {built:.1f}s")
+    print(f"memory: {used:.0f} MB ({used * 1024 * 1024 / n:.0f} bytes/name), "
+          f"{len(index.postings.lists)} grams, {entries} postings, max rss {rss_mb():.0f} MB")
+
+    # Одни и те же запросы для каждого размера каталога
+    rng = random.Random(args.seed + 1)
+
+    def typo(word: str) -> str:
+        i = rng.randrange(len(word) - 1)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+    kinds = {
+        "word": lambda: rng.choice(vocab),
+        "prefix": lambda: rng.choice(vocab)[:4],
+        "short": lambda: rng.choice(vocab)[:rng.randint(1, 2)],
+        "typo": lambda: typo(rng.choice(vocab)),
+        "ext": lambda: rng.choice(bot.ALLOWED_EXTENSIONS),
+    }
+    stats = {}
+    print(f"{'query':<10}{'results':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for kind, make in kinds.items():
+        times, results = [], 0
+        for _ in range(args.queries):
+            q = make()
+            t = time.perf_counter()
+            results += len(index.search(q, 0))
+            times.append(time.perf_counter() - t)
+        stats[kind] = (percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000)
+        print(f"{kind:<10}{results / args.queries:>10.0f}{stats[kind][0]:>10.2f}{stats[kind][1]:>10.2f}")
+    return stats
+
+
+def bench_search(args) -> None:
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    vocab = sorted({"".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(args.vocab)})
+    sizes = sorted(args.n)
+    stats = {}
+    for n in sizes:
+        stats[n] = search_latency(bot, args, n, vocab)
+        print()
+    if len(sizes) < 2:
+        return
+    # Выдача ограничена SEARCH_MAX_RESULTS: задержка не должна расти вместе с каталогом
+    small, large = stats[sizes[0]], stats[sizes[-1]]
+    slow = [kind for kind, (p50, _) in large.items() if p50 > args.budget_ms]
+    print(f"{sizes[-1]} vs {sizes[0]} names, p50: "
+          + ", ".join(f"{kind} ×{large[kind][0] / max(small[kind][0], 1e-3):.1f}" for kind in large))
+    print(f"p50 budget {args.budget_ms} ms: {'exceeded by ' + ', '.join(slow) if slow else 'ok'}")
+    if slow:
+        raise SystemExit(1)
+
+
+# ---------- ЗАГЛУШКА BOT API ----------
+class StubRequest:
+    # Отвечает на запросы Bot API без сети. Скачивание и отправка файлов
+    # «длятся» transfer секунд, остальные методы — api секунд.
+    TRANSFER_METHODS = {"getFile", "sendDocument"}
+
+    def __init__(self, api: float, transfer: float, file_size: int):
+        self.api = api
+        self.transfer = transfer
+        self.payload = b"\0" * file_size
+        self.calls = {}
+        self._ids = itertools.count(1)
+
+    def result(self, method: str, params: dict):
+        msg = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 1), "type": "private"},
+        }
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": "u" + params["file_id"],
+                    "file_size": len(self.payload), "file_path": "documents/file"}
+        if method == "sendDocument":
+            file_id = f"sent{msg['message_id']}"
+            return dict(msg, document={"file_id": file_id, "file_unique_id": "u" + file_id,
+                                       "file_name": params.get("filename") or "file",
+                                       "file_size": len(self.payload)})
+        if method in ("sendMessage", "editMessageText"):
+            return dict(msg, text=params.get("text", ""))
+        return True
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> tuple:
+        if "/file/bot" in url:
+            self.calls["download"] = self.calls.get("download", 0) + 1
+            await asyncio.sleep(self.transfer)
+            return 200, self.payload
+        api_method = url.rsplit("/", 1)[1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        await asyncio.sleep(self.transfer if api_method in self.TRANSFER_METHODS else self.api)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self.result(api_method, params)}, default=str).encode()
+
+
+def make_stub_request(api: float, transfer: float, file_size: int):
+    from telegram.request import BaseRequest
+
+    class Request(StubRequest, BaseRequest):
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        @property
+        def read_timeout(self):
+            return 5.0
+
+    return Request(api, transfer, file_size)
+
+
+# ---------- СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ----------
+WORDS = ["skin", "pack", "mod", "texture", "world", "map", "shader", "addon", "craft", "steve", "zombie", "castle"]
+
+
+class Updates:
+    def __init__(self, tg_bot):
+        self.tg_bot = tg_bot
+        self._ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields):
+        from telegram import Update
+        msg = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            **fields,
+        }
+        return Update.de_json({"update_id": next(self._ids), "message": msg}, self.tg_bot)
+
+    def text(self, user_id: int, text: str):
+        if text.startswith("/"):
+            entity = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            return self._message(user_id, text=text, entities=entity)
+        return self._message(user_id, text=text)
+
+    def document(self, user_id: int, name: str, size: int, unique_id=None, media_group=None):
+        file_id = f"up{next(self._ids)}"
+        extra = {"media_group_id": media_group} if media_group else {}
+        return self._message(user_id, document={
+            "file_id": file_id, "file_unique_id": unique_id or "u" + file_id, "file_name": name,
+            "file_size": size, "mime_type": "application/octet-stream",
+        }, **extra)
+
+    def callback(self, user_id: int, data: str):
+        from telegram import Update
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        msg = {"message_id": next(self._ids), "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"}, "text": "-"}
+        return Update.de_json({"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "from": user, "chat_instance": "bench", "data": data, "message": msg,
+        }}, self.tg_bot)
+
+
+def session(rng: random.Random, updates: Updates, bot, user_id: int, files: int) -> list:
+    # Одно действие пользователя: список (обработчик, обновление)
+    kind = rng.choices(["upload", "rename", "batch", "browse", "search", "download", "privacy"],
+                       weights=[12, 5, 3, 25, 30, 15, 10])[0]
+    name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}{rng.choice(bot.ALLOWED_EXTENSIONS)}"
+    if kind in ("upload", "rename"):
+        # Каждая пятая загрузка — уже известное каталогу содержимое
+        unique_id = f"useed{rng.randrange(files)}" if files and rng.random() < 0.2 else None
+        steps = [("start", updates.text(user_id, "/start")),
+                 ("handle_document", updates.document(user_id, name, 4096, unique_id))]
+        if kind == "rename":
+            steps += [("button_callback", updates.callback(user_id, "change_name")),
+                      ("handle_filename", updates.text(user_id, f"{rng.choice(WORDS)}_{user_id}")),
+                      ("process_file", updates.callback(user_id, "confirm_save"))]
+        else:
+            steps += [("process_file", updates.callback(user_id, "keep_as_is"))]
+        return steps
+    if kind == "batch":
+        # Альбом из 10 документов, общее расширение, одно сохранение
+        group = f"g{user_id}_{rng.random()}"
+        steps = [("start", updates.text(user_id, "/start"))]
+        steps += [("handle_document", updates.document(user_id, f"{rng.choice(WORDS)}_{i}.png", 4096,
+                                                       media_group=group)) for i in range(10)]
+        return steps + [("button_callback", updates.callback(user_id, "set_ext.mcpack")),
+                        ("process_file", updates.callback(user_id, "keep_as_is"))]
+    if kind == "browse":
+        cursor = rng.randint(1, max(1, files))
+        return [("browse_files", updates.text(user_id, "/browse")),
+                ("show_files_page", updates.callback(user_id, f"page_b1>{cursor}"))]
+    if kind == "search":
+        query = rng.choice([rng.choice(WORDS), rng.choice(WORDS)[:3], rng.choice(bot.ALLOWED_EXTENSIONS)])
+        return [("search_files", updates.text(user_id, "/search")),
+                ("handle_search", updates.text(user_id, query))]
+    if kind == "download":
+        return [("download_file", updates.callback(user_id, f"download_{rng.randint(1, max(1, files))}"))]
+    return [("toggle_privacy", updates.text(user_id, "/privacy")),
+            ("button_callback", updates.callback(user_id, "manage_individual")),
+            ("button_callback", updates.callback(user_id, "toggle_0"))]
+
+
+# ---------- МЕНЮ ----------
+# Так меню строились в каждом обработчике до появления готовых клавиатур
+def built_start(bot):
+    kb = [
+        [bot.InlineKeyboardButton("💳 Подписка", callback_data="cmd_subscribe")],
+        [bot.InlineKeyboardButton("🔐 Приватность", callback_data="cmd_privacy")],
+        [bot.InlineKeyboardButton("📂 Просмотр файлов", callback_data="cmd_browse")],
+        [bot.InlineKeyboardButton("🔍 Поиск", callback_data="cmd_search")],
+    ]
+    text = "👋 Привет, bench!\n\n" + "\n".join(f"• {e}" for e in bot.ALLOWED_EXTENSIONS)
+    return text, bot.InlineKeyboardMarkup(kb)
+
+
+def built_ext(bot):
+    kb = [[bot.InlineKeyboardButton(ext, callback_data=f"set_ext{ext}")] for ext in bot.ALLOWED_EXTENSIONS]
+    kb.append([bot.InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
+    return bot.InlineKeyboardMarkup(kb)
+
+
+def built_privacy(bot, files: list):
+    msg = "📋 Ваши файлы:\n\n"
+    kb = []
+    for i, f in enumerate(files, 1):
+        msg += f"{i}. {'🔓' if f.public else '🔒'} {f.filename}\n"
+        kb.append([bot.InlineKeyboardButton(f"{'Скрыть' if f.public else 'Показать'} {f.filename}",
+                                            callback_data=f"toggle_{i - 1}")])
+    kb.append([bot.InlineKeyboardButton("◀️ Назад", callback_data="back_to_privacy")])
+    return msg, bot.InlineKeyboardMarkup(kb)
+
+
+def bench_render(args) -> None:
+    bot = load_bot()
+    files = as_records(bot, synthetic_fields(bot, args.files))
+    pages = bot.PrivacyPages(1)
+
+    def cached_privacy():
+        return pages.get(1, files, 0)
+
+    def toggled_privacy():
+        # Переключение файла: страница с ним рисуется заново
+        pages.changed(1, 0)
+        return pages.get(1, files, 0)
+
+    cases = (
+        ("start", lambda: built_start(bot),
+         lambda: (f"👋 Привет, bench!\n\n{bot.WELCOME_TEXT}", bot.START_MARKUP)),
+        ("change_ext", lambda: built_ext(bot), lambda: bot.EXT_MARKUP),
+        (f"privacy/{args.files}", lambda: built_privacy(bot, files), cached_privacy),
+        ("privacy toggle", lambda: built_privacy(bot, files), toggled_privacy),
+    )
+    print(f"{'menu':<18}{'built us':>10}{'ready us':>10}")
+    for name, built, ready in cases:
+        row = []
+        for fn in (built, ready):
+            t = time.perf_counter()
+            for _ in range(args.repeat):
+                fn()
+            row.append((time.perf_counter() - t) / args.repeat * 1e6)
+        print(f"{name:<18}{row[0]:10.1f}{row[1]:10.1f}")
+
+
+# ---------- НАГРУЗКА ----------
+async def seed(bot, files: int, users: int, rng: random.Random) -> None:
+    now = time.time()
+    exts = bot.ALLOWED_EXTENSIONS
+    for user_id in range(1, users + 1):
+        bot.subscribed_users.add(user_id)
+        bot.storage.add_subscription(user_id)
+    ids = iter(await bot.storage.new_ids(files))
+    for i in range(files):
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}{rng.choice(exts)}"
+        bot.storage.save_file(bot.FileRecord(
+            next(ids), rng.randint(1, users), f"seed{i}", name, rng.random() < 0.9,
+            now - files + i, rng.randint(1024, 10 * 1024 * 1024), "application/octet-stream", name
+        ), f"useed{i}")
+    await bot.storage.flush()
+
+
+async def run_load(args) -> None:
+    os.environ['BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    if args.metrics:
+        # Сводка пишется в лог раз в час — за время замера только итоговая
+        os.environ['METRICS_LOG_INTERVAL'] = '3600'
+    bot = load_bot()
+    logging.getLogger().setLevel(logging.WARNING)
+    from telegram.ext import ApplicationBuilder
+
+    rng = random.Random(args.seed)
+    request = make_stub_request(args.api_ms / 1000, args.transfer_ms / 1000, args.file_kb * 1024)
+    api = bot.InstrumentedRequest(request) if args.metrics else request
+    app = bot.build_app(ApplicationBuilder().token("123456:BENCH").request(api).get_updates_request(request))
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    started = time.perf_counter()
+    await seed(bot, args.files, args.users, rng)
+    seeded = time.perf_counter()
+    await bot.search_index.ensure_loaded()
+    indexed = time.perf_counter()
+    print(f"catalogue: {args.files} files, {args.users} users")
+    print(f"seed {seeded - started:.2f}s, search index {indexed - seeded:.2f}s, rss {rss_mb():.0f} MB")
+
+    updates = Updates(app.bot)
+    queue = []
+    while len(queue) < args.updates:
+        user_id = rng.randint(1, args.users)
+        queue.append((user_id, session(rng, updates, bot, user_id, args.files)))
+
+    latencies = {}
+    sem = asyncio.Semaphore(args.concurrency)
+    # Действия одного пользователя — по очереди, как в PerUserUpdateProcessor
+    user_locks = {}
+
+    async def play(user_id: int, steps: list) -> None:
+        async with sem, user_locks.setdefault(user_id, asyncio.Lock()):
+            for handler, update in steps:
+                t = time.perf_counter()
+                await app.process_update(update)
+                latencies.setdefault(handler, []).append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(play(user_id, steps) for user_id, steps in queue))
+    handled = time.perf_counter()
+    await bot.transfers.shutdown()
+    drained = time.perf_counter()
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"updates: {total} in {handled - t0:.2f}s = {total / (handled - t0):.0f} updates/s "
+          f"(+{drained - handled:.2f}s to drain transfers)")
+    print(f"{'handler':<18}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for handler, values in sorted(latencies.items()):
+        print(f"{handler:<18}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}")
+    print(f"bot api calls: {dict(sorted(request.calls.items()))}")
+    print(f"search cache: {bot.file_search_cache.stats()}")
+    print(f"max rss {rss_mb():.0f} MB")
+    if args.metrics:
+        print(bot.metrics.render(), end="")
+
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+
+
+def bench_load(args) -> None:
+    asyncio.run(run_load(args))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("records", help="память на одну запись файла")
+    p.add_argument("-n", type=int, default=1_000_000)
+    p.set_defaults(func=bench_records)
+
+    p = sub.add_parser("search", help="индекс поиска: построение и задержка запросов")
+    p.add_argument("-n", type=int, nargs="+", default=[100_000], help="имён файлов (можно несколько размеров)")
+    p.add_argument("--vocab", type=int, default=20_000, help="различных слов в именах")
+    p.add_argument("--queries", type=int, default=200, help="запросов каждого вида")
+    p.add_argument("--budget-ms", type=float, default=10.0, help="предел p50 на самом большом каталоге")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("render", help="построение меню: каждый раз против готовых")
+    p.add_argument("--files", type=int, default=200, help="файлов у пользователя")
+    p.add_argument("--repeat", type=int, default=2_000)
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("load", help="задержки обработчиков и пропускная способность")
+    p.add_argument("--files", type=int, default=10_000, help="файлов в каталоге (1k–1M)")
+    p.add_argument("--users", type=int, default=1_000, help="пользователей (1k–100k)")
+    p.add_argument("--updates", type=int, default=2_000, help="действий пользователей")
+    p.add_argument("--concurrency", type=int, default=50, help="пользователей одновременно")
+    p.add_argument("--api-ms", type=float, default=2.0, help="задержка обычного вызова Bot API")
+    p.add_argument("--transfer-ms", type=float, default=50.0, help="задержка getFile/скачивания/sendDocument")
+    p.add_argument("--file-kb", type=int, default=64, help="размер скачиваемого файла")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--metrics", action="store_true", help="включить метрики и вывести их в конце")
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()